@@ -0,0 +1,57 @@
+"""Benchmark of the single-record predict path against LinearModel.predict.
+
+Run from the repository root with:
+
+    python benchmarks/predict_one.py
+"""
+
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from salmon import LinearModel, Q, C, Log
+
+
+def main(n=10000, repeat=5):
+    rng = np.random.RandomState(0)
+    data = pd.DataFrame({
+        "x1": rng.rand(n),
+        "x2": rng.rand(n) + 1,
+        "x3": rng.rand(n),
+        "group": rng.choice(list("abcdefghij"), n),
+    })
+    data["y"] = data.x1 + 2 * np.log(data.x2) + rng.randn(n)
+
+    model = LinearModel(
+        Q("x1") + Log(Q("x2")) + Q("x3") + C("group") * Q("x1"),
+        Q("y"),
+    )
+    model.fit(data)
+
+    record = {"x1": 0.3, "x2": 1.5, "x3": 0.2, "group": "c"}
+    names = model.compile().names
+    row = tuple(record[name] for name in names)
+    frame = pd.DataFrame([record])
+    records = [record] * 1000
+
+    assert np.isclose(
+        model.predict_one(record),
+        model.predict(frame).iloc[0, 0],
+    )
+
+    cases = [
+        ("predict (one-row DataFrame)", lambda: model.predict(frame), 200),
+        ("predict_one (dict)", lambda: model.predict_one(record), 20000),
+        ("predict_one (tuple)", lambda: model.predict_one(row), 20000),
+        ("predict_records (1000 dicts)",
+            lambda: model.predict_records(records), 20),
+    ]
+    for name, func, number in cases:
+        best = min(timeit.repeat(func, number=number, repeat=repeat))
+        per_call = best / number * 1e6
+        print("{:<30} {:>10.2f} us per call".format(name, per_call))
+
+
+if __name__ == "__main__":
+    main()
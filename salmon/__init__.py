@@ -1,4 +1,7 @@
 from .expression import *
 from .model import *
 from .comparison import *
-from .building import *
\ No newline at end of file
+from .building import *
+from .rolling import *
+from .grouped import *
+from .compiled import *
\ No newline at end of file
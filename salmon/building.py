@@ -1,24 +1,43 @@
 import numpy as np
 import math
+import os
 """Contains the logic for automatic model building (i.e. stepwise regression)."""
 
+import heapq
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-from .model import LinearModel
-from .comparison import _extract_dfs
+from .model import LinearModel, FitSummary, _DesignFactor
 from .expression import Constant
 
 
 class Score(ABC):
-    """Generic metric object for model evaluation."""
+    """Generic metric object for model evaluation.
+
+    Scores are computed from the FitSummary of a fitted model (its summary_),
+    which holds the number of rows and columns, the sums of squares and the
+    rank, so computing one costs the same for any number of rows. A custom
+    metric subclasses Score and implements compute with self.summary; the
+    class (or any callable taking a model and returning a Score) can be given
+    to stepwise in place of a metric name. A Score can also be made from a
+    FitSummary directly.
+    """
 
     def __init__(self, model, higher_is_better):
         self.higher_is_better = higher_is_better
         self.model = model
 
         if model is None:
+            self.summary = None
             self._score = np.inf * (-1 if higher_is_better else 1)
+        elif isinstance(model, FitSummary):
+            # Scoring a subset that was never fit (see best_subsets)
+            self.model = None
+            self.summary = model
+            self._score = self.compute()
         else:
+            self.summary = model.summary_
             self._score = self.compute()
 
     @abstractmethod
@@ -56,33 +75,19 @@ class RSquared(Score):
         )
 
     def compute(self):
-        """ Calculate the (adjusted) R^2 value of the model.
-
-        Arguments:
-            X - An optional DataFrame of the explanatory data to be used for
-                calculating R^2. Default is the training data.
-            Y - An optional DataFrame of the response data to be used for
-                calculating R^2. Default is the training data.
-            adjusted - A boolean indicating if the R^2 value is adjusted (True)
-                or not (False).
+        """ Calculate the (adjusted) R^2 value of the model on its training
+        data.
 
         Returns:
             A real value of the computed R^2 value.
         """
-
-        X = self.model.training_data
-        y = self.model.training_y
-
-        pred = self.model.predict(X)
-        sse = ((y.iloc[:, 0] - pred.iloc[:, 0]) ** 2).sum()
-        ssto = ((y.iloc[:, 0] - y.iloc[:, 0].mean()) ** 2).sum()
-
+        summary = self.summary
         if self.adjusted:
-            numerator = sse
-            denominator = ssto
+            numerator = summary.sse / (summary.n - summary.p - 1)
+            denominator = summary.sst / (summary.n - 1)
         else:
-            numerator = sse / (len(y) - len(self.model.X_train_.columns) - 2)
-            denominator = ssto / (len(y) - 1)
+            numerator = summary.sse
+            denominator = summary.sst
 
         return 1 - numerator / denominator
 
@@ -96,26 +101,35 @@ class MSE(Score):
         )
 
     def compute(self):
-        dfs = _extract_dfs(self.model, dict_out=True)
-        sse = self.model.get_sse()
-        return sse / dfs["error_df"]
+        # The residual variance, over the residual degrees of freedom of the
+        # fit (which account for absorbed factors)
+        return self.summary.sse / self.summary.rdf
 
 
 class MallowsCp(Score):
 
-    def __init__(self, model):
+    def __init__(self, model, sigma_sq=None):
+        """Create a MallowsCp score.
+
+        Arguments:
+            model - A fitted model.
+            sigma_sq - The estimate of the error variance, usually the
+                residual variance of the model with every candidate term.
+                Default is the residual variance of the model itself.
+        """
+        self.sigma_sq = sigma_sq
         super(MallowsCp, self).__init__(
             model=model,
             higher_is_better=False,
         )
 
     def compute(self):
-        dfs = _extract_dfs(self.model, dict_out=True)
-        sse = self.model.get_sse()
-        sigma_sq = self.model.std_err_est ** 2
-        n, p = self.model.n, self.model.p
+        summary = self.summary
+        sigma_sq = self.sigma_sq
+        if sigma_sq is None:
+            sigma_sq = summary.resid_var
 
-        return sse / sigma_sq - n + (2 * p)
+        return summary.sse / sigma_sq - summary.n + (2 * summary.p)
 
 
 class AIC(Score):
@@ -127,8 +141,8 @@ class AIC(Score):
         )
 
     def compute(self):
-        p = self.model.p
-        log_likelihood = self.model.log_likelihood()
+        p = self.summary.p
+        log_likelihood = self.summary.log_likelihood()
 
         return 2 * (p - log_likelihood)
 
@@ -142,8 +156,8 @@ class BIC(Score):
         )
 
     def compute(self):
-        n, p = self.model.n, self.model.p
-        log_likelihood = self.model.log_likelihood()
+        n, p = self.summary.n, self.summary.p
+        log_likelihood = self.summary.log_likelihood()
 
         return math.log(n) * p - 2 * log_likelihood
 
@@ -158,6 +172,96 @@ _metrics = dict(
 )
 
 
+def _metric_func(metric_name, full_model):
+    """Helper function that looks up the metric of a model search.
+
+    Returns:
+        A tuple of a function making a Score of a model and the name of the
+        metric.
+    """
+    if callable(metric_name):
+        return metric_name, getattr(metric_name, "__name__", str(metric_name))
+
+    metric_name = metric_name.lower()
+    if metric_name not in _metrics:
+        raise KeyError("Metric '{}' not supported. The following metrics are supported: {}".format(
+            metric_name,
+            list(_metrics.keys())
+        ))
+    if metric_name == "cp":
+        # Mallows' Cp estimates the error variance by the full model
+        return lambda model: MallowsCp(model, full_model.resid_var_), metric_name
+    return _metrics[metric_name], metric_name
+
+
+class TermHierarchy:
+    """The marginality graph of the terms of a model: which terms depend on
+    which others being present. A term depends on every term it contains,
+    e.g. an interaction between 'X' and 'Y' depends on both 'X' and 'Y', and
+    a square of 'X' depends on 'X'.
+
+    The graph is built once, from pairwise checks of containment, after
+    which whether a term can be added to or removed from a set of terms
+    without breaking the hierarchy is a lookup. Terms are keyed by their
+    string form, and either a term or its name can be given to any method.
+    """
+
+    def __init__(self, terms):
+        """Creates a TermHierarchy object.
+
+        Arguments:
+            terms - A collection of single terms (e.g. the get_terms() of a
+                model's explanatory Expression). Constants are left out.
+        """
+        terms = [term for term in terms if not isinstance(term, Constant)]
+        self.names = [str(term) for term in terms]
+        self._parents = {name: set() for name in self.names}
+        self._children = {name: set() for name in self.names}
+        for term, name in zip(terms, self.names):
+            for other, other_name in zip(terms, self.names):
+                if name != other_name and term.contains(other):
+                    self._parents[name].add(other_name)
+                    self._children[other_name].add(name)
+
+    @staticmethod
+    def from_model(model):
+        """Creates the TermHierarchy of the explanatory terms of a fitted
+        model."""
+        if model.ex is None:
+            raise AssertionError("The model must be fit prior to building its term hierarchy.")
+        return TermHierarchy(model.ex.get_terms())
+
+    def __len__(self):
+        return len(self.names)
+
+    def parents(self, term):
+        """Returns the set of names of the terms that a term depends on."""
+        return self._parents[str(term)]
+
+    def children(self, term):
+        """Returns the set of names of the terms that depend on a term."""
+        return self._children[str(term)]
+
+    def can_add(self, term, included):
+        """Returns true if every term that a term depends on is among the
+        names in included (a set)."""
+        return self._parents[str(term)] <= included
+
+    def can_remove(self, term, included):
+        """Returns true if no term that depends on a term is among the names
+        in included (a set)."""
+        return self._children[str(term)].isdisjoint(included)
+
+
+def _explanatory(terms):
+    """Helper function that adds an intercept and some terms into the
+    explanatory Expression of a model."""
+    explanatory = Constant(1)
+    for term in terms:
+        explanatory = explanatory + term
+    return explanatory
+
+
 def stepwise(
     full_model,
     metric_name,
@@ -165,6 +269,7 @@ def stepwise(
     naive=False,
     data=None,
     verbose=False,
+    n_jobs=1,
 ):
     """Perform forward or backward stepwise regression.
     
@@ -173,18 +278,25 @@ def stepwise(
             considered for the procedure.
         metric_name - A string containing the name of the metric to use in
             the procedure. Options include: "r_squared", "r_squared_adjusted",
-            "mse", "cp", "aic", and "bic".
+            "mse", "cp", "aic", and "bic". A custom Score class (or callable
+            taking a model and returning a Score) may be given instead.
         forward - If True, specifies forwards stepwise regression. If False,
             specifies backwards stepwise regression. Default is False.
         naive - If True, allows for the removal or addition of terms in a
             model that depend on others being present (e.g. removing variable
             'X' while an interaction between 'X' and 'Y' are still present).
-            Defaults to False.
+            The dependencies are those of the TermHierarchy of the terms of
+            the full_model. Defaults to False.
         data - A dataframe that, if specified, will be used for the stepwise
             regression. If not specified, it is assumed the full_model has
             already been trained using some other data.
         verbose - If True, will print to console periodic updates.
             Default is False.
+        n_jobs - The number of threads the candidate models of each step are
+            fit on. The threads share the factor of the full design, so no
+            data is copied, and the results are merged in the order of the
+            terms, so the outcome matches that of a single thread. A value
+            of -1 uses every CPU. Default is 1.
 
     Returns:
          
@@ -193,76 +305,106 @@ def stepwise(
     if data is not None:
         full_model.fit(data)
 
-    metric_name = metric_name.lower()
-
     ex_terms = full_model.ex
     re_term = full_model.re
-    data = full_model.training_data
 
     if ex_terms is None or re_term is None:
         raise AssertionError("The full model must be fit prior to undergoing a stepwise procedure.")
 
-    if metric_name not in _metrics:
-        raise KeyError("Metric '{}' not supported. The following metrics are supported: {}".format(
-            metric_name,
-            list(_metrics.keys())
-        ))
+    metric_func, metric_name = _metric_func(metric_name, full_model)
 
-    metric_func = _metrics[metric_name]
+    # Every candidate is fit from the factor of the full design, keeping the
+    # QR decomposition of the current model's columns and updating it by
+    # the columns of one term, so the data is only evaluated once
+    factor = _DesignFactor(full_model)
 
-    ex_term_list = ex_terms.get_terms()
+    ex_term_list = [
+        term for term in ex_terms.get_terms()
+        if not isinstance(term, Constant)
+    ]
+    if not naive:
+        hierarchy = TermHierarchy(ex_term_list)
     if forward:
         best_model = LinearModel(Constant(1), re_term)
-        best_model.fit(data)
+        best_qr = factor.qr([])
+        best_model._fit_factor(factor, best_qr, lean=True)
     else:
         best_model = full_model
+        best_qr = factor.qr(ex_term_list)
 
     best_metric = metric_func(best_model)
-      
 
-    while len(ex_term_list) > 0:
-        best_potential_metric = metric_func(None)
-        best_potential_model = None
-        best_idx = None
-    
-        if forward and not naive:
-            ex_term_list_expression = None
-            for t in ex_term_list:
-                if ex_term_list_expression is None:
-                    ex_term_list_expression = t
-                else:
-                    ex_term_list_expression = ex_term_list_expression + t
-            # Find all terms that do not depend on other terms
-            leaves = set(term for term in ex_term_list if not \
-                term.contains(ex_term_list_expression - term))
+    def fit_candidate(term):
+        # Fit and score the current best model with a term added or removed,
+        # or return None if the fit is singular
+        try:
+            if forward:
+                potential_qr = factor.add(best_qr, term)
+            else:
+                potential_qr = factor.remove(best_qr, term)
+            # The candidate is built from its terms rather than by adding or
+            # subtracting a term, as subtracting some terms (e.g. powers)
+            # leaves them behind with a scale of 0
+            potential_model = LinearModel(
+                _explanatory(factor.terms[name] for name in potential_qr.terms),
+                re_term,
+            )
+
+            # Candidates only need their scores; the inference of the
+            # chosen model is computed if it is ever looked at
+            potential_model._fit_factor(factor, potential_qr, lean=True)
+            return potential_model, potential_qr, metric_func(potential_model)
+
+        except np.linalg.linalg.LinAlgError:
+            return None
+
+    n_jobs = os.cpu_count() if n_jobs == -1 else max(1, n_jobs)
+    if n_jobs > 1:
+        pool = ThreadPoolExecutor(n_jobs)
+    try:
+        while len(ex_term_list) > 0:
+            best_potential_metric = metric_func(None)
+            best_potential_model = None
+            best_potential_qr = None
+            best_idx = None
     
-        for i, term in enumerate(ex_term_list):
-            try:
+            # The terms left to consider: those not yet added when going
+            # forward, or those still in the model when going backward
+            remaining = set(str(term) for term in ex_term_list)
+
+            candidates = []
+            for i, term in enumerate(ex_term_list):
                 if forward:
-                    # validate if adding term is valid
+                    # validate if adding term is valid (i.e. it does not
+                    # depend on a term that is yet to be added)
                     if not naive:
-                        if term not in leaves:
+                        if not hierarchy.parents(term).isdisjoint(remaining):
                             continue
-                    potential_model = LinearModel(
-                        best_model.given_ex + term, 
-                        re_term,
-                    )
                 else:
                     # validate if removing term is valid
                     if not naive:
-                        if (best_model.given_ex - term).contains(term):
+                        if not hierarchy.can_remove(term, remaining):
                             continue
-                    potential_model = LinearModel(
-                        best_model.given_ex - term,
-                        re_term,
-                    )
-
-                potential_model.fit(data)
-                potential_metric = metric_func(potential_model)
+                candidates.append((i, term))
+
+            # The candidates are fit on the pool (with the current best model
+            # and QR decomposition), but merged in order so that ties go to the
+            # first term as with a single thread
+            terms = [term for _, term in candidates]
+            if n_jobs > 1:
+                results = pool.map(fit_candidate, terms)
+            else:
+                results = map(fit_candidate, terms)
+
+            for (i, term), result in zip(candidates, results):
+                if result is None:
+                    continue
+                potential_model, potential_qr, potential_metric = result
 
                 if best_potential_metric.compare(potential_metric):
                     best_potential_metric = potential_metric
                     best_potential_model = potential_model
+                    best_potential_qr = potential_qr
                     best_idx = i
 
                 if verbose:
@@ -271,25 +413,30 @@ def stepwise(
                     print("Current best potential model" if best_idx == i else "Not current best potential")
                     print()
 
-            except np.linalg.linalg.LinAlgError:
-                continue
-
-        if best_metric.compare(best_potential_metric):
-            best_metric = best_potential_metric
-            best_model = best_potential_model
-            if verbose:
-                print("!!! New model found. Now including", ex_term_list[best_idx])
-                print()
-            del ex_term_list[best_idx]
+            if best_metric.compare(best_potential_metric):
+                best_metric = best_potential_metric
+                best_model = best_potential_model
+                best_qr = best_potential_qr
+                if verbose:
+                    print("!!! New model found. Now including", ex_term_list[best_idx])
+                    print()
+                del ex_term_list[best_idx]
+            else:
+                if verbose:
+                    print("!!! No potential models better than prior. Exiting search.")
+                    print()
+                break
         else:
             if verbose:
-                print("!!! No potential models better than prior. Exiting search.")
-                print()
-            break
-    else:
-        if verbose:
-            print("!!! Exhausted all potential terms. None left to consider.")
+                print("!!! Exhausted all potential terms. None left to consider.")
+    finally:
+        if n_jobs > 1:
+            pool.shutdown()
 
+    # Candidates are fit from the factor, without their training data, fitted
+    # values or residuals, so the chosen model is refit on the data
+    if best_model is not full_model:
+        best_model.fit(factor.data)
 
     return dict(
         forward=forward,
@@ -297,3 +444,211 @@ def stepwise(
         metric_name=metric_name,
         best_model=best_model
     )
+
+
+def _sweep(A, K, reverse=False):
+    """Helper function that sweeps (or reverse sweeps) a symmetric matrix on
+    the block of indices K, returning a new matrix. Sweeping the columns of
+    X in the cross product matrix of [X, y] leaves the sum of squared
+    residuals of y on X in its last entry, and a reverse sweep undoes a
+    sweep."""
+    J = np.setdiff1d(np.arange(len(A)), K)
+    inv = np.linalg.inv(A[np.ix_(K, K)])
+    A_JK = A[np.ix_(J, K)]
+    sign = -1 if reverse else 1
+    swept = np.empty_like(A)
+    swept[np.ix_(K, K)] = -inv
+    swept[np.ix_(J, K)] = sign * np.dot(A_JK, inv)
+    swept[np.ix_(K, J)] = swept[np.ix_(J, K)].T
+    swept[np.ix_(J, J)] = A[np.ix_(J, J)] - np.dot(A_JK, np.dot(inv, A_JK.T))
+    return swept
+
+
+def best_subsets(
+    full_model,
+    metric_name,
+    max_size,
+    respect_hierarchy=True,
+    n_best=1,
+    data=None,
+):
+    """Find the best models of every number of terms, up to max_size, among
+    all subsets of the terms of a model.
+
+    Uses the leaps and bounds algorithm of Furnival and Wilson: subsets are
+    visited as a tree, where every subtree holds the subsets of one set of
+    terms that contain another. The sum of squared residuals of a set of
+    terms (found by a reverse sweep of the cross product matrix from its
+    parent's) bounds that of every subset in its subtree, so subtrees that
+    cannot hold one of the best models are pruned without fitting any of
+    them. The metric must get better as the sum of squared residuals falls
+    and be monotone in the number of columns, as all default metrics are.
+
+    Arguments:
+        full_model - A model object that contains all of the terms to be
+            considered.
+        metric_name - A string containing the name of the metric to use (see
+            stepwise) or a custom Score class.
+        max_size - The largest number of terms of a model to report.
+        respect_hierarchy - If True, only consider models that include every
+            term that their terms depend on (e.g. both 'X' and 'Y' when an
+            interaction between them is present), as stepwise does when
+            naive=False. Default is True.
+        n_best - The number of models to report per number of terms.
+            Default is 1.
+        data - A dataframe that, if specified, will be used to fit the
+            full_model first.
+
+    Returns:
+        A dictionary with the metric_name, the best model and its metric
+        overall, and 'subsets', an OrderedDict mapping every number of
+        terms to a list of (metric, model) pairs, best first.
+    """
+    if data is not None:
+        full_model.fit(data)
+
+    if full_model.ex is None or full_model.re is None:
+        raise AssertionError("The full model must be fit prior to a best subsets search.")
+
+    metric_func, metric_name = _metric_func(metric_name, full_model)
+    sign = -1 if metric_func(None).higher_is_better else 1
+
+    factor = _DesignFactor(full_model)
+    n = factor.n
+    gram = np.dot(factor.R.T, factor.R)
+    sst = gram[-1, -1]
+    terms = list(factor.terms)
+    widths = [len(factor.columns[name]) for name in terms]
+    max_size = min(max_size, len(terms))
+
+    # descendants[i] are the terms that depend on term i, and ancestors[i]
+    # those that term i depends on
+    descendants = [set() for _ in terms]
+    ancestors = [set() for _ in terms]
+    if respect_hierarchy:
+        hierarchy = TermHierarchy(factor.terms.values())
+        index = dict((name, i) for i, name in enumerate(terms))
+        for i, name in enumerate(terms):
+            descendants[i] = set(index[other] for other in hierarchy.children(name))
+            ancestors[i] = set(index[other] for other in hierarchy.parents(name))
+
+    def key(sse, p):
+        # The metric of a subset from its sufficient statistics; lower keys
+        # are better
+        summary = FitSummary(n, p, sse, sst, p + 1, n - p - 1)
+        return sign * metric_func(summary)._score
+
+    # The best n_best subsets of every size, as heaps of (-key, -order,
+    # terms) so that the worst is on top and ties go to the first found
+    best = {size: [] for size in range(1, max_size + 1)}
+    found = [0]
+
+    def record(included, sse):
+        size = len(included)
+        if size not in best:
+            return
+        subset = tuple(sorted(included))
+        if any(entry[2] == subset for entry in best[size]):
+            return
+        p = sum(widths[i] for i in included)
+        entry = (-key(sse, p), -found[0], subset)
+        found[0] += 1
+        if len(best[size]) < n_best:
+            heapq.heappush(best[size], entry)
+        elif entry > best[size][0]:
+            heapq.heapreplace(best[size], entry)
+
+    def prunable(fixed, free, sse):
+        # Whether no subset of fixed + free that contains fixed can be among
+        # the best of its size, given that its SSE is at least sse
+        free_widths = sorted(widths[i] for i in free)
+        p_fixed = sum(widths[i] for i in fixed)
+        sizes = range(
+            max(len(fixed), 1),
+            min(len(fixed) + len(free), max_size) + 1,
+        )
+        for size in sizes:
+            extra = size - len(fixed)
+            p_min = p_fixed + sum(free_widths[:extra])
+            p_max = p_fixed + sum(free_widths[len(free_widths) - extra:])
+            bound = min(key(sse, p_min), key(sse, p_max))
+            if len(best[size]) < n_best or bound < -best[size][0][0]:
+                return False
+        return True
+
+    # Branch on the terms whose removal costs the most first, which gives
+    # the tightest bounds
+    full = _sweep(gram, [c for name in terms for c in factor.columns[name]])
+    costs = [
+        _sweep(full, factor.columns[name], reverse=True)[-1, -1]
+        for name in terms
+    ]
+    branch_order = sorted(range(len(terms)), key=lambda i: -costs[i])
+
+    # Seed the best subsets with those of a forward search, so that there
+    # are good subsets to bound against from the start
+    included, swept = [], gram
+    for _ in range(max_size):
+        candidates = []
+        for i in range(len(terms)):
+            if i in included or not ancestors[i] <= set(included):
+                continue
+            try:
+                candidate = _sweep(swept, factor.columns[terms[i]])
+            except np.linalg.LinAlgError:
+                continue
+            record(included + [i], candidate[-1, -1])
+            candidates.append((candidate[-1, -1], i, candidate))
+        if not candidates:
+            break
+        _, i, swept = min(candidates, key=lambda candidate: candidate[:2])
+        included = included + [i]
+
+    def visit(fixed, free, swept):
+        # Every subset of fixed + free that contains fixed, where swept is
+        # the cross product matrix swept on all of fixed + free
+        record(fixed + free, swept[-1, -1])
+        for j, term in enumerate(free):
+            child_fixed = fixed + free[:j]
+            if len(child_fixed) > max_size:
+                break
+            # Dropping a term drops every term that depends on it
+            removed = set([term]) | descendants[term]
+            if removed.intersection(child_fixed):
+                continue
+            child_free = [i for i in free[j + 1:] if i not in removed]
+            columns = [
+                c for i in free if i in removed
+                for c in factor.columns[terms[i]]
+            ]
+            try:
+                child = _sweep(swept, columns, reverse=True)
+            except np.linalg.LinAlgError:
+                continue
+            if not prunable(child_fixed, child_free, child[-1, -1]):
+                visit(child_fixed, child_free, child)
+
+    visit([], branch_order, full)
+
+    # Fit the best subsets on the data to report them as fully fitted models
+    subsets = OrderedDict()
+    best_metric, best_model = None, None
+    for size in sorted(best):
+        subsets[size] = []
+        for _, _, included in sorted(best[size], reverse=True):
+            model = LinearModel(
+                _explanatory(factor.terms[terms[i]] for i in included),
+                full_model.re,
+            )
+            model.fit(factor.data)
+            metric = metric_func(model)
+            subsets[size].append((metric, model))
+            if best_metric is None or best_metric.compare(metric):
+                best_metric, best_model = metric, model
+
+    return dict(
+        metric=best_metric,
+        metric_name=metric_name,
+        best_model=best_model,
+        subsets=subsets,
+    )
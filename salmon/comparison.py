@@ -1,4 +1,5 @@
 from .model import *
+from .expression import term_cache
 from scipy.stats import f
 
 import numpy as np
@@ -21,7 +22,9 @@ def anova(model1, model2 = None):
         A DataFrame that contains relevant statistics for the test performed
     """
     if model2 is None:
-        return _anova_terms(model1)
+        # The model is refit without each of its terms on the same data
+        with term_cache.enabled():
+            return _anova_terms(model1)
     elif is_subset(model1, model2):
         return _anova_models(model1, model2)
     elif is_subset(model2, model1):
@@ -84,8 +87,13 @@ def _process_term(orig_model, term):
     Returns:
         A real value indicated the sum of squared residuals.
     """
+    if orig_model.training_data is None:
+        raise Exception(
+            "The model does not keep its training data (e.g. it was slimmed), "
+            "which the test of each term needs."
+        )
     new_model = LinearModel(orig_model.given_ex - term, orig_model.given_re)
-    new_model.fit(orig_model.training_data)
+    new_model.fit(orig_model.training_data, lean=True)
     return new_model.get_sse(), new_model.get_ssr()
 
 def _extract_dfs(model, dict_out=False):
@@ -102,7 +110,7 @@ def _extract_dfs(model, dict_out=False):
         of freedom for the model.
     """
     reg_df = model.ex.get_dof()
-    total_df = len(model.X_train_) - 1
+    total_df = model.n - 1
     error_df = total_df - reg_df
 
     if dict_out:
@@ -0,0 +1,419 @@
+"""Contains the logic for compiling a fitted LinearModel into a flat plan
+that predicts without evaluating the Expression tree."""
+
+import numpy as np
+import pandas as pd
+
+from .expression import (
+    Categorical,
+    Combination,
+    Constant,
+    Interaction,
+    Quantitative,
+    TransVar,
+)
+
+
+# Number of records from which predict_records switches to vectorized scoring
+_RECORDS_VECTORIZE = 64
+
+
+def _frozen(array):
+    """Helper function to make a read-only copy of an array."""
+    array = np.array(array, dtype=float)
+    array.flags.writeable = False
+    return array
+
+
+def _term_width(term):
+    """Helper function for the number of columns a (fitted) term evaluates
+    to."""
+    if isinstance(term, Combination):
+        return sum(_term_width(t) for t in term.terms)
+    if isinstance(term, Categorical):
+        return sum(level not in term.baseline for level in term.levels)
+    if isinstance(term, Interaction):
+        return int(np.prod([_term_width(t) for t in term.terms]))
+    if isinstance(term, Constant):
+        return 0 if term.scale == 0 else 1
+    return 1
+
+
+class _Compiler:
+    """Builds the flat plan of a CompiledModel, assigning every base column
+    it reads an index."""
+
+    def __init__(self):
+        self.names = []
+        self.categoricals = {}
+
+    def column(self, name):
+        if name not in self.names:
+            self.names.append(name)
+        return self.names.index(name)
+
+    def lookup(self, name, levels, code_map, strict):
+        """A factor that maps the values of a column to rows of a table:
+        (column index, levels, code map, strict). The last entry of the code
+        map is used for values not in levels (when not strict)."""
+        code_map = np.asarray(code_map, dtype=np.intp)
+        code_map.flags.writeable = False
+        return (self.column(name), pd.Index(levels), code_map, strict)
+
+    def categorical(self, term):
+        # Shared between terms so that codes are computed once per predict
+        key = term._cache_key()
+        if key in self.categoricals:
+            return self.categoricals[key]
+
+        code_map = []
+        width = 0
+        for level in term.levels:
+            if level in term.baseline:
+                code_map.append(-1)
+            else:
+                code_map.append(width)
+                width += 1
+        # Baseline levels share a zero row after the encoded ones
+        code_map = [width if code < 0 else code for code in code_map]
+        lookup = self.lookup(term.name, term.levels, code_map + [width], True)
+        self.categoricals[key] = lookup
+        return lookup
+
+    def value(self, term):
+        """A factor that evaluates to a single column of values."""
+        if isinstance(term, Quantitative):
+            return ("column", self.column(term.name), term.scale)
+        if isinstance(term, TransVar):
+            width = _term_width(term.var)
+            sub_plan = self.expression(term.var, np.ones((width, 1)))
+            return (
+                "transform",
+                sub_plan,
+                term.transformation.copy(),
+                term.scale,
+            )
+        if isinstance(term, Constant):
+            return ("constant", term.scale)
+        raise NotImplementedError(
+            "Cannot compile terms of type {}.".format(type(term).__name__)
+        )
+
+    def term(self, term, coef):
+        """A term of the plan: (lookup factors, value factors, table), where
+        the contribution of the term is the table indexed by the codes of
+        the lookups times the product of the values."""
+        if isinstance(term, Constant):
+            return ((), (), _frozen(term.scale * coef[0]))
+        if isinstance(term, Categorical):
+            table = np.vstack((coef, np.zeros((1, coef.shape[1]))))
+            return ((self.categorical(term),), (), _frozen(table))
+        if not isinstance(term, Interaction):
+            return ((), (self.value(term),), _frozen(coef[0]))
+
+        # Interaction columns vary fastest in the last of the sorted terms
+        factors = sorted(term.terms, key=str)
+        widths = [_term_width(factor) for factor in factors]
+        table = coef.reshape(widths + [coef.shape[1]])
+        lookups, values = [], []
+        for axis, factor in enumerate(factors):
+            if isinstance(factor, Categorical):
+                lookups.append(self.categorical(factor))
+                pad = [(0, 0)] * table.ndim
+                pad[axis] = (0, 1)
+                table = np.pad(table, pad)
+            elif widths[axis] == 1:
+                values.append(self.value(factor))
+            else:
+                raise NotImplementedError(
+                    "Cannot compile interactions with the multi-column "
+                    "term {}.".format(factor)
+                )
+        table = table.reshape(
+            [w + 1 for f, w in zip(factors, widths)
+             if isinstance(f, Categorical)] + [coef.shape[1]]
+        )
+        return (tuple(lookups), tuple(values), _frozen(table))
+
+    def expression(self, expression, coef):
+        """The plan of an Expression given its coefficients (one row per
+        column, one column per response)."""
+        if isinstance(expression, Combination):
+            terms = list(expression.terms)
+        else:
+            terms = [expression]
+
+        plan = []
+        start = 0
+        for term in terms:
+            width = _term_width(term)
+            if width:
+                plan.append(self.term(term, coef[start:start + width]))
+            start += width
+        return tuple(plan)
+
+
+def _scalar_plan(plan, single):
+    """Helper function to convert a plan into plain Python objects for
+    evaluating a single record: lookups become dicts and, for a single
+    response, tables become nested lists of floats."""
+    scalar_plan = []
+    for lookups, values, table in plan:
+        scalar_lookups = tuple(
+            (
+                index,
+                dict(zip(levels, code_map[:-1].tolist())),
+                None if strict else int(code_map[-1]),
+            )
+            for index, levels, code_map, strict in lookups
+        )
+        scalar_values = tuple(
+            value if value[0] != "transform" else
+            (value[0], _scalar_plan(value[1], True)) + value[2:]
+            for value in values
+        )
+        if single:
+            table = table[..., 0].tolist()
+        scalar_plan.append((scalar_lookups, scalar_values, table))
+    return tuple(scalar_plan)
+
+
+class CompiledModel:
+    """A flat, read-only prediction plan of a fitted LinearModel.
+
+    Categorical terms become lookups of their coefficients by level code,
+    Interactions become tables indexed by the codes of their Categorical
+    factors and scaled by their other factors, and plain Quantitative terms
+    are gathered into a single matrix product. Categorical levels and
+    transformation parameters are frozen at compile time, so refitting the
+    model does not change the plan.
+    """
+
+    def __init__(self, model):
+        """Compile a fitted LinearModel.
+
+        Arguments:
+            model - A fitted LinearModel object.
+        """
+        coef = np.asarray(model.coef_, dtype=float)
+        self.multi_response = coef.ndim == 2
+        coef = coef.reshape(len(coef), -1)
+        if model.intercept:
+            coef, intercept = coef[:-1], coef[-1]
+        else:
+            intercept = np.zeros(coef.shape[1])
+        if model.multi_response:
+            self.names_out = ["Predicted " + str(term) for term in model.re]
+        else:
+            self.names_out = ["Predicted " + str(model.re)]
+
+        compiler = _Compiler()
+        plan = compiler.expression(model.ex, coef)
+
+        # Absorbed fixed effects are lookups that are NaN for unseen levels
+        for name in model.absorb or []:
+            effects = np.asarray(model.fixed_effects_[name], dtype=float)
+            effects = effects.reshape(len(effects), -1)
+            table = np.vstack((effects, np.full((1, coef.shape[1]), np.nan)))
+            code_map = np.arange(len(effects) + 1)
+            lookup = compiler.lookup(
+                name,
+                model.fixed_effects_[name].index,
+                code_map,
+                False,
+            )
+            plan += (((lookup,), (), _frozen(table)),)
+
+        # Gather the plain Quantitative terms into one matrix product
+        linear = [
+            (term[1][0][1], term[1][0][2] * term[2])
+            for term in plan
+            if not term[0] and len(term[1]) == 1 and term[1][0][0] == "column"
+        ]
+        self._plan = tuple(
+            term for term in plan
+            if term[0] or len(term[1]) != 1 or term[1][0][0] != "column"
+        )
+        self._linear_columns = tuple(index for index, _ in linear)
+        self._linear_coef = _frozen(
+            [row for _, row in linear] or np.empty((0, coef.shape[1]))
+        )
+        self._intercept = _frozen(intercept)
+        self.names = tuple(compiler.names)
+
+        # Plain Python version of the plan for scoring single records
+        single = not self.multi_response
+        self._scalar_plan = _scalar_plan(self._plan, single)
+        self._scalar_linear = tuple(
+            (index, float(row[0]) if single else row)
+            for index, row in zip(self._linear_columns, self._linear_coef)
+        )
+        self._scalar_intercept = float(intercept[0]) if single else \
+            self._intercept
+
+    def predict(self, data):
+        """Predict response values.
+
+        Arguments:
+            data - A DataFrame (or a dict of arrays) containing the values of
+                the explanatory variables.
+
+        Returns:
+            An array of the predictions, with a column per response for
+            multiple responses.
+        """
+        columns = [np.asarray(data[name]) for name in self.names]
+        n = len(columns[0]) if columns else len(data)
+        codes = {}
+
+        if self._linear_columns:
+            X = np.column_stack([
+                columns[index].astype(float, copy=False)
+                for index in self._linear_columns
+            ])
+            total = np.dot(X, self._linear_coef) + self._intercept
+        else:
+            total = np.tile(self._intercept, (n, 1))
+
+        for term in self._plan:
+            total += self._evaluate_term(term, columns, codes, n)
+
+        return total if self.multi_response else total[:, 0]
+
+    def predict_frame(self, data):
+        """Predict response values, labelled as LinearModel.predict does.
+
+        Arguments:
+            data - A DataFrame containing the values of the explanatory
+                variables.
+
+        Returns:
+            A DataFrame containing the predictions.
+        """
+        return pd.DataFrame(
+            self.predict(data).reshape(len(data), -1),
+            columns=self.names_out,
+            index=data.index,
+        )
+
+    def predict_one(self, record):
+        """Predict the response of a single record, without building any
+        arrays or DataFrames.
+
+        Arguments:
+            record - A dict mapping the names in self.names to values, or a
+                tuple (or list) of the values in the order of self.names.
+
+        Returns:
+            A float prediction, or a tuple of floats for multiple responses.
+        """
+        if isinstance(record, (tuple, list)):
+            row = record
+        else:
+            row = [record[name] for name in self.names]
+
+        total = self._scalar_intercept
+        for index, coef in self._scalar_linear:
+            total = total + coef * row[index]
+        for term in self._scalar_plan:
+            total = total + self._evaluate_scalar_term(term, row)
+
+        return total if not self.multi_response else tuple(total)
+
+    def predict_records(self, records):
+        """Predict the responses of a list of records.
+
+        Small batches are scored one record at a time, larger ones are
+        converted to columns and scored with vectorized operations.
+
+        Arguments:
+            records - A list of dicts or tuples, as taken by predict_one.
+
+        Returns:
+            An array of the predictions, with a column per response for
+            multiple responses.
+        """
+        if len(records) < _RECORDS_VECTORIZE:
+            return np.array([self.predict_one(record) for record in records])
+
+        rows = [
+            record if isinstance(record, (tuple, list)) else
+            [record[name] for name in self.names]
+            for record in records
+        ]
+        columns = dict(zip(self.names, map(np.asarray, zip(*rows))))
+        if not columns:
+            columns = np.empty(len(records))
+        return self.predict(columns)
+
+    def _evaluate_scalar_term(self, term, row):
+        """Helper function for the contribution of a single term to the
+        prediction of a single record."""
+        lookups, values, entry = term
+        for index, mapping, unknown in lookups:
+            code = mapping.get(row[index], unknown)
+            if code is None:
+                raise ValueError(
+                    "Level not seen while fitting: {}".format(row[index])
+                )
+            entry = entry[code]
+        for value in values:
+            entry = entry * self._evaluate_scalar_value(value, row)
+        return entry
+
+    def _evaluate_scalar_value(self, value, row):
+        """Helper function for the value of a value factor of a single
+        record."""
+        if value[0] == "column":
+            return value[2] * row[value[1]]
+        if value[0] == "constant":
+            return value[1]
+        _, sub_plan, transformation, scale = value
+        base = 0.0
+        for term in sub_plan:
+            base += self._evaluate_scalar_term(term, row)
+        return scale * transformation.transform(base, training=False)
+
+    def _evaluate_term(self, term, columns, codes, n):
+        """Helper function for the contribution of a single term."""
+        lookups, values, table = term
+        if lookups:
+            result = table[tuple(
+                self._codes(lookup, columns, codes) for lookup in lookups
+            )]
+        else:
+            result = np.broadcast_to(table, (n, table.shape[-1]))
+        for value in values:
+            result = result * self._evaluate_value(value, columns, codes, n)[
+                :, np.newaxis]
+        return result
+
+    def _evaluate_value(self, value, columns, codes, n):
+        """Helper function for the single column of a value factor."""
+        if value[0] == "column":
+            _, index, scale = value
+            return scale * columns[index].astype(float, copy=False)
+        if value[0] == "constant":
+            return np.full(n, value[1], dtype=float)
+        _, sub_plan, transformation, scale = value
+        base = np.zeros(n)
+        for term in sub_plan:
+            base += self._evaluate_term(term, columns, codes, n)[:, 0]
+        return scale * transformation.transform(base, training=False)
+
+    @staticmethod
+    def _codes(lookup, columns, codes):
+        """Helper function for the table rows of a lookup factor, computed
+        once per prediction."""
+        key = id(lookup)
+        if key not in codes:
+            index, levels, code_map, strict = lookup
+            positions = levels.get_indexer(columns[index])
+            if strict and (positions < 0).any():
+                raise ValueError(
+                    "Levels not seen while fitting: {}".format(
+                        list(pd.unique(columns[index][positions < 0]))
+                    )
+                )
+            codes[key] = code_map[positions]
+        return codes[key]
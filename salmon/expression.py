@@ -1,10 +1,16 @@
 """Describes the object-oriented symbolic algebra."""
 
 import collections
+import contextlib
+import copy as _copy
+import hashlib
+import threading
 import numpy as np
+import pandas as pd
 from functools import reduce
 from itertools import product
 from abc import ABC, abstractmethod
+from scipy import sparse
 from scipy.special import binom
 
 from . import transformation as _t 
@@ -18,10 +24,10 @@ STR_AS_REPR = False
 
 class LightDataFrame(np.ndarray):
 
-    def __new__(cls, input_array, columns=None):
+    def __new__(cls, input_array, columns=None, dtype=np.float64):
         # Input array is an already formed ndarray instance
         # We first cast to be our class type
-        obj = np.asarray(input_array, dtype=np.float64).view(cls)
+        obj = np.asarray(input_array, dtype=dtype).view(cls)
         # add the new attribute to the created instance
         obj.columns = columns
         # Finally, we must return the newly created object:
@@ -39,6 +45,202 @@ class LightDataFrame(np.ndarray):
         raise KeyError("Column %s not in LightDataFrame." % colname)
 
 
+def _sparse_frame(matrix, columns):
+    """Helper function to attach column names to a scipy.sparse CSR matrix,
+    the sparse counterpart of a LightDataFrame."""
+    matrix = sparse.csr_matrix(matrix)
+    matrix.columns = list(columns)
+    return matrix
+
+
+def _row_kron(A, B):
+    """Helper function for the row-wise Kronecker product of two sparse
+    matrices, i.e. the columns of every product of a column of A with a
+    column of B (B varying fastest), computed without densifying."""
+    A, B = sparse.csr_matrix(A), sparse.csr_matrix(B)
+    A.sort_indices()
+    B.sort_indices()
+    n = A.shape[0]
+    counts_A, counts_B = np.diff(A.indptr), np.diff(B.indptr)
+    counts = counts_A * counts_B
+    indptr = np.concatenate(([0], np.cumsum(counts)))
+
+    rows = np.repeat(np.arange(n), counts)
+    within = np.arange(indptr[-1]) - np.repeat(indptr[:-1], counts)
+    pos_A = A.indptr[rows] + within // counts_B[rows]
+    pos_B = B.indptr[rows] + within % counts_B[rows]
+
+    product = sparse.csr_matrix(
+        (
+            A.data[pos_A] * B.data[pos_B],
+            A.indices[pos_A] * B.shape[1] + B.indices[pos_B],
+            indptr,
+        ),
+        shape=(n, A.shape[1] * B.shape[1]),
+    )
+    product.eliminate_zeros()
+    return product
+
+
+class TermCache:
+    """A least recently used cache of the columns evaluated for single terms
+    of a Combination. This keeps model searches (stepwise, anova, partial
+    plots) that refit overlapping models on the same data from recomputing
+    identical polynomial, one-hot and interaction columns.
+
+    Entries are keyed by the term (including any learned state such as
+    Categorical levels), whether it is being fit, and a fingerprint of the
+    values of the columns it references. Once the cached columns exceed
+    max_bytes the least recently used entries are evicted. A max_bytes of
+    0 disables caching.
+
+    Caching is opt-in, as hashing the data and copying the columns only
+    pays off when the same data is evaluated again: evaluations only go
+    through the cache inside a "with term_cache.enabled():" block, which
+    anova and partial_plots open. Blocks only apply to the thread that
+    opens them, while the entries are shared by every thread under a lock.
+    """
+
+    def __init__(self, max_bytes=64 * 2 ** 20):
+        """Create a TermCache object.
+
+        Arguments:
+            max_bytes - An integer memory budget for the cached columns.
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # The number of open enabled() blocks, per thread
+        self._local = threading.local()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    @property
+    def active(self):
+        """Whether evaluations of the current thread go through the
+        cache."""
+        return getattr(self._local, "depth", 0) > 0 and self.max_bytes > 0
+
+    @contextlib.contextmanager
+    def enabled(self):
+        """Context manager within which evaluations of the current thread
+        go through the cache. Blocks may be nested."""
+        self._local.depth = getattr(self._local, "depth", 0) + 1
+        try:
+            yield self
+        finally:
+            self._local.depth -= 1
+
+    def get(self, key):
+        """Return the (columns, fitted term) entry for a key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, columns, term):
+        """Store the evaluated columns and fitted copy of a term."""
+        if columns.nbytes > self.max_bytes:
+            return
+        columns.flags.writeable = False
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (columns, term)
+            self.nbytes += columns.nbytes
+            self._evict()
+
+    def resize(self, max_bytes):
+        """Change the memory budget, evicting entries as needed."""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def _evict(self):
+        # Only called with the lock held
+        while self.nbytes > self.max_bytes and self._entries:
+            columns, _ = self._entries.popitem(last=False)[1]
+            self.nbytes -= columns.nbytes
+
+
+term_cache = TermCache()
+
+
+def _freeze(values):
+    """Helper function to make a collection of levels hashable."""
+    if values is None:
+        return None
+    return tuple(values)
+
+
+def _fingerprint(data, names, memo):
+    """Helper function that summarizes the values of some columns of a
+    DataFrame. Fingerprints of single columns are memoized in memo, which
+    should only live as long as a single evaluation of the data."""
+    fingerprint = [len(data)]
+    for name in sorted(names):
+        if name not in memo:
+            column = data[name]
+            hashed = pd.util.hash_pandas_object(column, index=False).values
+            memo[name] = (
+                str(column.dtype),
+                hashlib.blake2b(hashed.tobytes(), digest_size=16).digest(),
+            )
+        fingerprint.append((name, memo[name]))
+    return tuple(fingerprint)
+
+
+def _cacheable(term, data, fit, replaceable):
+    """Helper function for whether evaluating a term goes through the term
+    cache."""
+    return not (
+        not term_cache.active or
+        isinstance(term, (Quantitative, Constant)) or
+        not isinstance(data, pd.DataFrame) or
+        (fit and not replaceable)
+    )
+
+
+def _evaluate_cached(term, data, fit, memo, replaceable):
+    """Helper function that evaluates a single term through the term cache.
+
+    Returns:
+        A tuple of the evaluated columns and the term to keep. On a cache hit
+        while fitting this is a copy of the cached fitted term, so that the
+        caller picks up the learned state (e.g. Categorical levels).
+    """
+    if not _cacheable(term, data, fit, replaceable):
+        return term.evaluate(data, fit), term
+
+    base_terms = term.reduce()
+    names = set(v.name for key in ("Q", "C", "V") for v in base_terms[key])
+    key = (term._cache_key(), fit, _fingerprint(data, names, memo))
+
+    entry = term_cache.get(key)
+    if entry is None:
+        columns = term.evaluate(data, fit)
+        term_cache.put(key, columns, term.copy())
+        return columns, term
+
+    columns, fitted_term = entry
+    return columns, fitted_term.copy() if fit else term
+
+
 # ABC is a parent object that allows for Abstract methods
 class Expression(ABC):
     """The parent abstract class that all subsequent representations of
@@ -113,10 +315,27 @@ class Expression(ABC):
         """
         return hash(str(self))
 
+    def _cache_key(self):
+        """Return a hashable representation of an Expression, including any
+        state learned while fitting, for the purposes of caching evaluated
+        data."""
+        return (type(self).__name__, str(self))
+
     @abstractmethod
     def copy(self):
         """Creates a deep copy of an expression"""
         pass    
+
+    def freeze(self):
+        """Creates a deep copy of a fitted expression whose learned state
+        (e.g. Categorical levels, order of terms) is held in immutable
+        containers, so that evaluating it with fit=False has no side effects
+        and can be shared between threads.
+
+        Returns:
+            A frozen copy of the Expression.
+        """
+        return _copy.copy(self)
         
     @abstractmethod
     def interpret(self, data):
@@ -318,6 +537,54 @@ class Expression(ABC):
         # Transform the incoming data depending on what type of variable the
         # data is represented by
         pass
+
+    def plan_columns(self, data, fit = True):
+        """First phase of evaluating into a preallocated buffer: learn any
+        state from the data (if fit) and name the columns the Expression
+        evaluates to.
+
+        Arguments:
+            data - A DataFrame whose column names match the names of the base
+                Variable objects.
+            fit - A flag to reference when evaluating the data to know when to
+                overwrite Categorical levels.
+
+        Returns:
+            A list of the names of the columns.
+        """
+        return list(self.evaluate(data, fit).columns)
+
+    def evaluate_into(self, data, out, fit = True):
+        """Second phase of evaluating into a preallocated buffer: write the
+        columns named by plan_columns (which must be called first) into out.
+
+        Arguments:
+            data - A DataFrame whose column names match the names of the base
+                Variable objects.
+            out - A 2D array (e.g. a slice of a larger buffer) with a row per
+                row of data and a column per planned column.
+            fit - The same flag that was given to plan_columns.
+        """
+        out[...] = self.evaluate(data, fit)
+
+    def evaluate_sparse(self, data, fit = True):
+        """Given data, apply the appropriate transformations, combinations,
+        and interactions, keeping the result in a sparse format. Useful for
+        Categorical variables with many levels.
+
+        Arguments:
+            data - A DataFrame whose column names match the names of the base
+                Variable objects.
+            fit - A flag to reference when evaluating the data to know when to
+                overwrite Categorical levels.
+
+        Returns:
+            A scipy.sparse CSR matrix consisting of specified columns for each
+            term in the Expression, with the column names in its columns
+            attribute.
+        """
+        evaluated = self.evaluate(data, fit)
+        return _sparse_frame(evaluated, evaluated.columns)
     
     def reduce(self):
         """Obtain the base Quantitative, Categorical, Constant, and Varable
@@ -468,6 +735,12 @@ class TransVar(Expression):
             self.transformation.copy(),
             self.scale,
         )
+
+    def freeze(self):
+        frozen = _copy.copy(self)
+        frozen.var = self.var.freeze()
+        frozen.transformation = self.transformation.copy()
+        return frozen
     
     def __eq__(self, other):
         if isinstance(other, TransVar):
@@ -479,6 +752,14 @@ class TransVar(Expression):
     
     def __hash__(self):
         return hash((self.var, self.scale, self.transformation))
+
+    def _cache_key(self):
+        return (
+            type(self).__name__,
+            self.scale,
+            self.transformation._cache_key(),
+            self.var._cache_key(),
+        )
     
     def __add__(self, other):
         if isinstance(other, TransVar) and self.var == other.var and \
@@ -499,6 +780,9 @@ class TransVar(Expression):
         self.scale = 1
         self.var._descale()
         
+    def plan_columns(self, data, fit = True):
+        return [str(self)]
+
     def evaluate(self, data, fit = True):
         base_data = self.var.evaluate(data, fit).sum(axis=1)
         transformed_data = self.scale * self.transformation.transform(
@@ -562,6 +846,9 @@ class PowerVar(TransVar):
     
     def copy(self):
         return PowerVar(self.var, self.power, self.scale)
+
+    def _cache_key(self):
+        return (type(self).__name__, self.scale, self.power, self.var._cache_key())
     
     def __hash__(self):
         return hash((self.var, self.scale, self.transformation, self.power))
@@ -655,6 +942,12 @@ class Quantitative(Var):
             transformed_data[:, np.newaxis], 
             columns=[self.name],
         )
+
+    def plan_columns(self, data, fit = True):
+        return [self.name]
+
+    def evaluate_into(self, data, out, fit = True):
+        np.multiply(data[self.name].values, self.scale, out=out[:, 0])
     
     def _reduce(self, ret_dict):
         ret_dict["Q"].add(self)
@@ -720,6 +1013,12 @@ class Constant(Expression):
                 np.full((n, 1), self.scale),
                 columns=[str(self)],
             )
+
+    def plan_columns(self, data, fit = True):
+        return [] if self.scale == 0 else [str(self)]
+
+    def evaluate_into(self, data, out, fit = True):
+        out[...] = self.scale
         
     def _reduce(self, ret_dict):
         ret_dict['Constant'] = self.scale
@@ -766,6 +1065,15 @@ class Categorical(Var):
         
     def __str__(self):
         return self.name
+
+    def _cache_key(self):
+        return (
+            type(self).__name__,
+            self.name,
+            self.encoding,
+            _freeze(self.levels),
+            None if self.baseline is None else frozenset(self.baseline),
+        )
         
     def copy(self):
         return Categorical(
@@ -777,6 +1085,12 @@ class Categorical(Var):
                 
     def interpret(self, data):
         return self
+
+    def freeze(self):
+        frozen = _copy.copy(self)
+        frozen.levels = _freeze(self.levels)
+        frozen.baseline = _freeze(self.baseline)
+        return frozen
     
     #def transform(self, transformation):
     #    raise Exception("Categorical variables cannot be transformed.")
@@ -807,24 +1121,50 @@ class Categorical(Var):
                     self.levels.append(element)
         
         
-    def _one_hot_encode(self, data):
-        # keep track of the levels, including which ones are not in 
-        # the baseline
+    def _level_columns(self):
+        # map every level to the column it is encoded in, or -1 for
+        # levels in the baseline
         mapping = {}
-        keep = []
         columns = []
-        for i, level in enumerate(self.levels):
-            mapping[level] = i
-            if level not in self.baseline:
-                keep.append(i)
+        for level in self.levels:
+            if level in self.baseline:
+                mapping[level] = -1
+            else:
+                mapping[level] = len(columns)
                 columns.append("%s{%s}" % (self.name, level))
-        
+        return mapping, columns
+
+    def _one_hot_codes(self, data):
+        mapping, columns = self._level_columns()
+
         # define mapping of levels to integer codes
         codes = data[self.name].map(mapping)
+        if codes.isnull().any():
+            raise ValueError(
+                "Levels of %s not seen while fitting: %s" % (
+                    self.name,
+                    list(data[self.name][codes.isnull()].unique()),
+                )
+            )
+        codes = codes.values.astype(np.intp)
+        return codes, columns
+
+    def _one_hot_encode(self, data, sparse_output=False):
+        codes, columns = self._one_hot_codes(data)
+        rows = np.flatnonzero(codes >= 0)
+
+        # set a single one per row (none for the baseline), without
+        # materializing anything larger than the result
+        if sparse_output:
+            indptr = np.concatenate(([0], np.cumsum(codes >= 0)))
+            dummy_mat = sparse.csr_matrix(
+                (np.ones(len(rows)), codes[rows], indptr),
+                shape=(len(codes), len(columns)),
+            )
+            return _sparse_frame(dummy_mat, columns)
 
-        # create dummy matrix by taking the appropriate rows from an 
-        # identity matrix
-        dummy_mat = np.eye(len(self.levels))[:, keep].take(codes, axis=0)
+        dummy_mat = np.zeros((len(codes), len(columns)))
+        dummy_mat[rows, codes[rows]] = 1
         
         return LightDataFrame(dummy_mat, columns=columns)
         
@@ -836,6 +1176,29 @@ class Categorical(Var):
             return self._one_hot_encode(data)
         else:
             raise NotImplementedError()
+
+    def plan_columns(self, data, fit=True):
+        if self.levels is None or self.baseline is None or fit:
+            self._set_levels(data)
+        return self._level_columns()[1]
+
+    def evaluate_into(self, data, out, fit=True):
+        # The levels were learned by plan_columns
+        if self.encoding != 'one-hot':
+            raise NotImplementedError()
+        codes, _ = self._one_hot_codes(data)
+        rows = np.flatnonzero(codes >= 0)
+        out[...] = 0
+        out[rows, codes[rows]] = 1
+
+    def evaluate_sparse(self, data, fit=True):
+        if self.levels is None or self.baseline is None or fit:
+            self._set_levels(data)
+
+        if self.encoding == 'one-hot':
+            return self._one_hot_encode(data, sparse_output=True)
+        else:
+            raise NotImplementedError()
         
     def _reduce(self, ret_dict):
         ret_dict["C"].add(self)
@@ -878,6 +1241,13 @@ class Interaction(Expression):
     
     def __hash__(self):
         return hash((frozenset(self.terms), self.scale))
+
+    def _cache_key(self):
+        return (
+            type(self).__name__,
+            self.scale,
+            frozenset(term._cache_key() for term in self.terms),
+        )
         
     def __str__(self):
         base = "(" + ")(".join(sorted(str(term) for term in self.terms)) + ")" 
@@ -914,6 +1284,11 @@ class Interaction(Expression):
 
     def copy(self):
         return Interaction({term.copy() for term in self.terms}, self.scale)
+
+    def freeze(self):
+        frozen = _copy.copy(self)
+        frozen.terms = frozenset(term.freeze() for term in self.terms)
+        return frozen
         
     def interpret(self, data):
         self.terms = set(term.interpret(data) for term in self.terms)
@@ -952,7 +1327,10 @@ class Interaction(Expression):
             term._descale()
             
     def evaluate(self, data, fit=True):
-        trans_data_sets = [term.evaluate(data, fit) for term in self.terms]
+        # Sorted so the column order does not depend on set iteration order
+        trans_data_sets = [
+            term.evaluate(data, fit) for term in sorted(self.terms, key=str)
+        ]
         # rename columns in sets
         for data_set in trans_data_sets:
             data_set.columns = ["({})".format(col) for col in data_set.columns]
@@ -973,6 +1351,48 @@ class Interaction(Expression):
             )
             
         return base_set
+
+    def plan_columns(self, data, fit=True):
+        columns = [""]
+        for term in sorted(self.terms, key=str):
+            columns = [
+                base_col + "({})".format(other_col)
+                for base_col in columns
+                for other_col in term.plan_columns(data, fit)
+            ]
+        return columns
+
+    def evaluate_into(self, data, out, fit=True):
+        # Each column is the product of one column of every term, the last
+        # of the sorted terms varying fastest
+        trans_data_sets = [
+            term.evaluate(data, fit) for term in sorted(self.terms, key=str)
+        ]
+        widths = [data_set.shape[1] for data_set in trans_data_sets]
+        for k, index in enumerate(np.ndindex(*widths)):
+            column = out[:, k]
+            column[...] = trans_data_sets[0][:, index[0]]
+            for data_set, i in zip(trans_data_sets[1:], index[1:]):
+                np.multiply(column, data_set[:, i], out=column)
+
+    def evaluate_sparse(self, data, fit=True):
+        trans_data_sets = [
+            term.evaluate_sparse(data, fit)
+            for term in sorted(self.terms, key=str)
+        ]
+
+        base_set = trans_data_sets[0]
+        base_columns = ["({})".format(col) for col in base_set.columns]
+        for other_set in trans_data_sets[1:]:
+            other_columns = ["({})".format(col) for col in other_set.columns]
+            base_set = _row_kron(base_set, other_set)
+            base_columns = [
+                base_col + other_col
+                for base_col in base_columns
+                for other_col in other_columns
+            ]
+
+        return _sparse_frame(base_set, base_columns)
     
     def _reduce(self, ret_dict):
         for term in self.terms:
@@ -1098,7 +1518,18 @@ class Combination(Expression):
             self._add_term(term)
         
     def copy(self):
-        return Combination({term.copy() for term in self.terms}, self.scale)
+        # The terms are already simplified, so they are copied as they are
+        # rather than added one by one
+        ret_comb = Combination((), self.scale)
+        ret_comb.terms = {term.copy() for term in self.terms}
+        return ret_comb
+
+    def freeze(self):
+        # A tuple keeps the order of the columns and is never swapped for
+        # cached terms while evaluating
+        frozen = _copy.copy(self)
+        frozen.terms = tuple(term.freeze() for term in self.terms)
+        return frozen
         
     def interpret(self, data):
         self.terms = [term.interpret(data) for term in self.terms]
@@ -1145,15 +1576,58 @@ class Combination(Expression):
         for term in self.terms:
             term._descale()
             
-    def evaluate(self, data, fit = True):
-        dataframes = []
-        columns = []
+    def evaluate(self, data, fit = True, dtype = np.float64):
+        """Evaluate the Combination into a single preallocated,
+        Fortran-ordered buffer: the columns of every term are planned first
+        (learning any state), then written into their slice of the buffer.
+
+        Arguments:
+            data - A DataFrame whose column names match the names of the base
+                Variable objects.
+            fit - A flag to reference when evaluating the data to know when to
+                overwrite Categorical levels.
+            dtype - The data type of the buffer. Default is float64.
+
+        Returns:
+            A LightDataFrame with the columns of every term.
+        """
+        # Terms are only swapped for their cached fitted copies once
+        # interpreted into a list, as a set may change iteration order
+        replaceable = isinstance(self.terms, list)
+        memo = {}
+        blocks = []
         for term in self.terms:
-            df = term.evaluate(data, fit)
-            dataframes.append(df)
-            columns.extend(df.columns)
+            if _cacheable(term, data, fit, replaceable):
+                df, term = _evaluate_cached(term, data, fit, memo, replaceable)
+                blocks.append((term, list(df.columns), df))
+            else:
+                blocks.append((term, term.plan_columns(data, fit), None))
+        if replaceable:
+            self.terms = [term for term, _, _ in blocks]
+
+        columns = [column for _, term_columns, _ in blocks
+                   for column in term_columns]
+        out = np.empty((len(data), len(columns)), dtype=dtype, order="F")
+        start = 0
+        for term, term_columns, df in blocks:
+            view = out[:, start:start + len(term_columns)]
+            if df is None:
+                term.evaluate_into(data, view, fit)
+            else:
+                view[...] = df
+            start += len(term_columns)
         
-        return LightDataFrame(np.hstack(dataframes), columns=columns)
+        return LightDataFrame(out, columns=columns, dtype=dtype)
+
+    def evaluate_sparse(self, data, fit = True):
+        blocks = []
+        columns = []
+        for term in self.terms:
+            block = term.evaluate_sparse(data, fit)
+            blocks.append(block)
+            columns.extend(block.columns)
+
+        return _sparse_frame(sparse.hstack(blocks, format="csr"), columns)
     
     def _reduce(self, ret_dict):
         for term in self.terms:
@@ -0,0 +1,134 @@
+"""Contains the logic for fitting one model per group of a partition of the
+data."""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.stats as stats
+
+from .model import _factor_estimates
+
+
+def _fit_groups(Z, offsets, intercept):
+    """Fits every group of rows of [1, X, y], where the rows are sorted by
+    group.
+
+    Groups are bucketed by size and each bucket is zero padded (which does
+    not change the R factor) so that it can be decomposed as a single stack
+    of small QR problems.
+
+    Arguments:
+        Z - A 2D array [1, X, y] with the rows of each group contiguous.
+        offsets - An array of the index of the first row of each group,
+            followed by the total number of rows.
+        intercept - A boolean indicating whether an intercept is fit.
+
+    Returns:
+        A tuple of three elements: the coefficients, their standard errors and
+        the residual variance of every group.
+    """
+    sizes = np.diff(offsets)
+    q = Z.shape[1]
+    R = np.zeros((len(sizes), q, q))
+
+    buckets = np.ceil(np.log2(np.maximum(sizes, 1))).astype(int)
+    for bucket in np.unique(buckets):
+        groups = np.flatnonzero(buckets == bucket)
+        group_sizes = sizes[groups]
+
+        # Scatter the rows of the bucket into a zero padded stack
+        position = np.repeat(np.arange(len(groups)), group_sizes)
+        starts = np.cumsum(group_sizes) - group_sizes
+        within = np.arange(group_sizes.sum()) - np.repeat(starts, group_sizes)
+        rows = np.repeat(offsets[groups], group_sizes) + within
+        stack = np.zeros((len(groups), group_sizes.max(), q))
+        stack[position, within] = Z[rows]
+
+        r = np.linalg.qr(stack, mode="r")
+        R[groups, :r.shape[1]] = r
+
+    return _factor_estimates(R, sizes, intercept)
+
+
+def fit_by(model, data, by, n_jobs=1):
+    """Fit a model separately on each group of rows sharing a value of a
+    column.
+
+    The design matrix is evaluated once on all of the data, so Categorical
+    levels and transformation parameters are shared by every group. The
+    groups are then solved together as a batch of small least squares
+    problems, optionally split across a pool of processes. Groups that do
+    not have enough rows, or whose design is rank deficient, get NaN
+    estimates.
+
+    Arguments:
+        model - A LinearModel object whose explanatory and response
+            Expressions define the model to fit. It is not modified.
+        data - A DataFrame containing all of the explanatory and response
+            variables in the model as well as the grouping column.
+        by - The name of the column to group the rows by.
+        n_jobs - The number of processes to split the groups across. A value
+            of -1 uses every CPU. Default is 1 (no pool).
+
+    Returns:
+        A DataFrame of the coefficients, standard errors, t statistics and
+        p-values of every group, indexed by (group, term).
+    """
+    re = model.given_re.copy().interpret(data)
+    ex = model.given_ex.copy().interpret(data)
+    X = ex.evaluate(data)
+    y = re.evaluate(data)
+    Z = np.hstack((np.ones((len(X), 1)), X, y))
+
+    columns = list(X.columns)
+    if model.intercept:
+        columns.append("Intercept")
+
+    # Make the rows of each group contiguous (rows with a missing group are
+    # left out)
+    codes, groups = pd.factorize(data[by], sort=True)
+    if (codes[1:] < codes[:-1]).any() or (codes < 0).any():
+        order = np.argsort(codes, kind="stable")
+        order = order[codes[order] >= 0]
+        Z = Z[order]
+    counts = np.bincount(codes[codes >= 0], minlength=len(groups))
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    n_jobs = max(1, min(n_jobs, len(groups)))
+
+    if n_jobs == 1:
+        coefs, ses, _ = _fit_groups(Z, offsets, model.intercept)
+    else:
+        splits = np.linspace(0, len(groups), n_jobs + 1).astype(int)
+        tasks = [
+            (
+                Z[offsets[start]:offsets[end]],
+                offsets[start:end + 1] - offsets[start],
+                model.intercept,
+            )
+            for start, end in zip(splits[:-1], splits[1:])
+        ]
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(_fit_groups, *zip(*tasks)))
+        coefs = np.concatenate([result[0] for result in results])
+        ses = np.concatenate([result[1] for result in results])
+
+    rdf = counts - len(columns)
+    with np.errstate(invalid="ignore"):
+        t = coefs / ses
+        p = 2 * stats.t.cdf(-abs(t), rdf[:, np.newaxis])
+
+    return pd.DataFrame(
+        {
+            "Coefficient": coefs.ravel(),
+            "SE": ses.ravel(),
+            "t": t.ravel(),
+            "p": p.ravel(),
+        },
+        index=pd.MultiIndex.from_product([groups, columns], names=[by, None]),
+        columns=["Coefficient", "SE", "t", "p"],
+    )
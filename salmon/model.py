@@ -1,9 +1,16 @@
 """Describes various linear models supported by SALMON."""
 
+import os
+import threading
+
 import numpy as np
 
+import scipy.linalg
 import scipy.stats as stats
-from scipy.linalg import solve_triangular, cho_solve
+from scipy import sparse
+from scipy.linalg import solve_triangular, cho_solve, cholesky
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import splu, lsqr, LinearOperator
 
 import pandas as pd
 from pandas.plotting import scatter_matrix
@@ -11,13 +18,42 @@ from pandas.plotting import scatter_matrix
 import matplotlib.pyplot as plt
 
 from itertools import product
-from collections import OrderedDict
+from functools import lru_cache
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from .expression import Combination, Identity, Constant
+from .expression import Combination, Identity, Constant, term_cache
+from .compiled import CompiledModel
 
 plt.style.use('ggplot')
 
 
+# Largest number of coefficients for which a sparse fit still stores the
+# full (dense) covariance matrix
+_SPARSE_COV_MAX = 2000
+# Number of columns of the inverse Gram matrix solved for at a time
+_SPARSE_BLOCK = 256
+# Largest connected group of levels of more than two absorbed factors whose
+# degrees of freedom are found (from a dense Gram matrix)
+_ABSORB_RANK_MAX = 4000
+# Size in bytes of the temporary used per chunk of interval widths
+_INTERVAL_CHUNK_BYTES = 16 * 2**20
+# Shapes for which solver="auto" uses the normal equations
+_CHOLESKY_MIN_ROWS = 100000
+_CHOLESKY_MAX_COLS = 200
+# Size in bytes of the block of centered rows used to form the Gram matrix
+_CHOLESKY_BLOCK_BYTES = 16 * 2**20
+# Largest number of rows in a block of a TSQR factorization
+_TSQR_BLOCK_ROWS = 2**18
+# Number of rows of the sketch per column of the design matrix
+_SKETCH_FACTOR = 10
+# Tolerance of the preconditioned LSQR iterations
+_SKETCH_TOL = 1e-12
+# Largest condition number of the (scaled) design matrix for which the
+# normal equations are trusted; squaring it must leave enough digits
+_CHOLESKY_MAX_COND = 1e5
+
+
 def _float_format(x):
     abs_x = abs(x)
     if abs_x >= 1e4:
@@ -67,6 +103,778 @@ def cho_inv(R):
         return np.empty(shape=(0, 0))
 
 
+def qr_append_rows(R, rows):
+    """Update the R of a QR decomposition after appending rows to the
+    decomposed matrix (Householder update of the stacked triangle)."""
+    return np.linalg.qr(np.vstack((R, rows)), mode="r")
+
+
+def qr_delete_rows(R, rows):
+    """Downdate the R of a QR decomposition after deleting rows from the
+    decomposed matrix, i.e. find R' with R'.T @ R' == R.T @ R - D.T @ D.
+    Done with one hyperbolic Householder reflection per column, so the cost
+    is O(m p^2) for m rows."""
+    # Reflections assume a positive diagonal, flipping rows keeps R.T @ R
+    signs = np.where(np.diagonal(R) < 0, -1.0, 1.0)
+    R = R * signs[:, np.newaxis]
+    D = np.array(rows, dtype=np.float64, ndmin=2)
+    last = R.shape[1] - 1
+    # a ** 2 - w_sq loses digits to cancellation, so a column whose norm
+    # falls this far is left for a fresh factorization (and may well have
+    # lost all of its rows, e.g. those of a level)
+    tol = np.sqrt(np.finfo(np.float64).eps)
+    for k in range(R.shape[1]):
+        w = D[:, k]
+        w_sq = np.dot(w, w)
+        if w_sq == 0:
+            continue
+        a = R[k, k]
+        a_new_sq = a ** 2 - w_sq
+        if k < last and a_new_sq <= tol * a ** 2:
+            raise np.linalg.LinAlgError(
+                "Deleting rows would leave a (nearly) rank deficient matrix."
+            )
+        if a_new_sq <= 0:
+            # Residual sum of squares may round to slightly below zero
+            R[k, k] = 0
+            break
+        a_new = np.sqrt(a_new_sq)
+        # u = [a - a_new, w] maps [a, w] onto [a_new, 0], the first element
+        # is rewritten to avoid cancellation
+        u_0 = w_sq / (a + a_new)
+        scale = (u_0 * R[k, k:] - np.dot(w, D[:, k:])) / (a_new * u_0)
+        R[k, k:] += u_0 * scale
+        D[:, k:] += np.outer(w, scale)
+    return R
+
+
+def _factor_estimates(R, n, intercept):
+    """Obtains coefficients, standard errors and residual variance from the
+    triangular factor R of [1, X, y]. R may be a stack of factors (with a
+    matching array of row counts n), in which case every problem is solved
+    at once. Rank deficient problems get NaN estimates.
+
+    Arguments:
+        R - The upper triangular R of a QR decomposition of [1, X, y], or a
+            stack of them.
+        n - The number of rows in each decomposed matrix.
+        intercept - A boolean indicating whether an intercept is fit.
+
+    Returns:
+        A tuple of three elements: the coefficients (intercept last), their
+        standard errors and the residual variance.
+    """
+    if not intercept:
+        R = np.linalg.qr(R[..., 1:], mode="r")
+
+    k = R.shape[-1] - 1
+    r, z = R[..., :-1, :-1], R[..., :-1, -1]
+    diag = np.abs(np.diagonal(r, axis1=-2, axis2=-1))
+    tol = np.finfo(np.float64).eps * k * diag.max(axis=-1, initial=0)
+    singular = (diag <= tol[..., np.newaxis]).any(axis=-1) | (n <= k)
+    r = np.where(singular[..., np.newaxis, np.newaxis], np.identity(k), r)
+
+    r_inv = np.linalg.inv(r)
+    coef = np.matmul(r_inv, z[..., np.newaxis])[..., 0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        resid_var = R[..., -1, -1] ** 2 / (n - k)
+        se = np.sqrt(resid_var[..., np.newaxis] * (r_inv ** 2).sum(axis=-1))
+    coef = np.where(singular[..., np.newaxis], np.nan, coef)
+    se = np.where(singular[..., np.newaxis], np.nan, se)
+    resid_var = np.where(singular, np.nan, resid_var)
+
+    if intercept:
+        # Intercept is the first column of the factor but the last
+        # coefficient in fitted tables
+        coef = np.roll(coef, -1, axis=-1)
+        se = np.roll(se, -1, axis=-1)
+    return coef, se, resid_var
+
+
+def _sweep_groups(Z, codes, tol=1e-10, max_iter=10000):
+    """Helper function to sweep the group means of one or more grouping
+    factors out of the columns of Z (in place), by alternating projections.
+
+    A single factor is swept out exactly in one pass; several factors are
+    swept in turn until the largest change is negligible.
+
+    Arguments:
+        Z - A 2D array whose columns are to be demeaned.
+        codes - A list of integer arrays, the group of every row for each
+            factor.
+        tol - The tolerance on the largest change in a sweep, relative to the
+            largest entry of Z.
+        max_iter - The maximum number of sweeps over all of the factors.
+
+    Returns:
+        A list of 2D arrays, the accumulated means removed for each group of
+        each factor. Their sum over the factors gives the original Z minus
+        the demeaned Z.
+    """
+    counts = [np.bincount(code) for code in codes]
+    removed = [np.zeros((len(count), Z.shape[1])) for count in counts]
+    threshold = tol * max(np.abs(Z).max(), 1) if Z.size else 0
+
+    for _ in range(max_iter):
+        change = 0
+        for code, count, total in zip(codes, counts, removed):
+            indicator = sparse.csr_matrix(
+                (np.ones(len(code)), (code, np.arange(len(code)))),
+                shape=(len(count), len(code)),
+            )
+            means = (indicator @ Z) / count[:, np.newaxis]
+            Z -= means[code]
+            total += means
+            change = max(change, np.abs(means).max(initial=0))
+        if len(codes) == 1 or change <= threshold:
+            return removed
+
+    raise Exception(
+        "Sweeping out the absorbed factors did not converge in {} "
+        "iterations.".format(max_iter)
+    )
+
+
+def _absorbed_df(codes):
+    """Helper function to count the degrees of freedom used by absorbed
+    factors, the rank of the indicator columns of all of their levels.
+
+    Levels are linked when observations fall in both, and the rank is found
+    within every connected component of the levels. For one or two factors
+    this is a count: every level, less one per component for two factors.
+    For more factors, the factors may be nested or overlap in any way, so
+    the rank of every component is computed from its Gram matrix, which
+    limits components to _ABSORB_RANK_MAX levels.
+    """
+    levels = [code.max() + 1 for code in codes]
+    if len(codes) == 1:
+        return levels[0]
+
+    # Levels of every factor are the nodes, observations link the levels of
+    # consecutive factors they fall in
+    offsets = np.cumsum([0] + levels)
+    nodes = [code + offset for code, offset in zip(codes, offsets)]
+    graph = sparse.csr_matrix(
+        (
+            np.ones(len(codes[0]) * (len(codes) - 1)),
+            (np.concatenate(nodes[:-1]), np.concatenate(nodes[1:])),
+        ),
+        shape=(offsets[-1], offsets[-1]),
+    )
+    components, labels = connected_components(graph, directed=False)
+    if len(codes) == 2:
+        return offsets[-1] - components
+
+    indicator = sparse.csr_matrix(
+        (
+            np.ones(len(codes[0]) * len(codes)),
+            (np.tile(np.arange(len(codes[0])), len(codes)), np.concatenate(nodes)),
+        ),
+        shape=(len(codes[0]), offsets[-1]),
+    )
+    gram = (indicator.T @ indicator).tocsr()
+    order = np.argsort(labels, kind="stable")
+    sizes = np.bincount(labels, minlength=components)
+    df = 0
+    for members in np.split(order, np.cumsum(sizes)[:-1]):
+        if len(members) == 1:
+            # A level no other level shares observations with
+            df += 1
+            continue
+        if len(members) > _ABSORB_RANK_MAX:
+            raise ValueError(
+                "The degrees of freedom of more than two absorbed factors "
+                "can only be found for connected groups of at most {} "
+                "levels.".format(_ABSORB_RANK_MAX)
+            )
+        block = gram[members][:, members].toarray()
+        df += np.linalg.matrix_rank(block)
+    return df
+
+
+def _split_chunks(chunks, chunk_rows):
+    """Helper function to split an iterable of DataFrames into chunks of at
+    most chunk_rows rows."""
+    for chunk in chunks:
+        if chunk_rows is None:
+            yield chunk
+            continue
+        for start in range(0, len(chunk), chunk_rows):
+            yield chunk.iloc[start:start + chunk_rows]
+
+
+# Size of the .npy header reserved by _write_npy, enough for any shape
+_NPY_HEADER_BYTES = 128
+
+
+def _npy_header(rows, columns):
+    """Helper function for a version 1.0 .npy header of a fixed size."""
+    header = "{{'descr': '<f8', 'fortran_order': False, 'shape': ({}, {}), }}"
+    header = header.format(rows, columns)
+    magic = np.lib.format.magic(1, 0)
+    length = _NPY_HEADER_BYTES - len(magic) - 2
+    header = header.ljust(length - 1) + "\n"
+    return magic + length.to_bytes(2, "little") + header.encode("latin1")
+
+
+def _write_npy(path, blocks):
+    """Helper function to write 2D blocks of rows to a .npy file as they
+    come, filling in the final shape once all of them are written.
+
+    Returns:
+        A read-only memmap of the written array.
+    """
+    rows, columns = 0, 0
+    with open(path, "wb") as f:
+        f.write(_npy_header(0, 0))
+        for block in blocks:
+            block = np.ascontiguousarray(block, dtype="<f8")
+            rows, columns = rows + block.shape[0], block.shape[1]
+            f.write(block.tobytes())
+        f.seek(0)
+        f.write(_npy_header(rows, columns))
+    return np.load(path, mmap_mode="r")
+
+
+class _Moments:
+    """Running column means and centered cross products of a matrix whose
+    rows arrive in chunks. Chunks are merged with the pairwise update of
+    Chan et al., which is far more stable than accumulating raw sums."""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        self.comoment = None
+
+    def update(self, Z):
+        """Merge the rows of a 2D array into the running statistics."""
+        m = len(Z)
+        if m == 0:
+            return
+        mean = Z.mean(axis=0)
+        Z_c = Z - mean[np.newaxis, :]
+        comoment = np.dot(Z_c.T, Z_c)
+
+        if self.n == 0:
+            self.n, self.mean, self.comoment = m, mean, comoment
+        else:
+            n = self.n + m
+            delta = mean - self.mean
+            self.comoment = self.comoment + comoment + \
+                np.outer(delta, delta) * (self.n * m / n)
+            self.mean = self.mean + delta * (m / n)
+            self.n = n
+
+    def cross_product(self):
+        """Return the uncentered cross product matrix Z.T @ Z."""
+        return self.comoment + self.n * np.outer(self.mean, self.mean)
+
+
+def _read_only(values):
+    """Helper function to make a read-only array copy of some values."""
+    if values is None:
+        return None
+    values = np.array(values, dtype=float)
+    values.flags.writeable = False
+    return values
+
+
+def _lazy_inference(name):
+    """Helper function to make a property for an inference attribute (e.g.
+    the covariance matrix) that a lean fit only computes once the attribute
+    is first accessed."""
+    key = "_" + name
+
+    def get(self):
+        if self._pending_inference is not None:
+            self._build_inference()
+        try:
+            return self.__dict__[key]
+        except KeyError:
+            raise AttributeError(name)
+
+    def set(self, value):
+        self.__dict__[key] = value
+
+    return property(get, set)
+
+
+def _rank(r):
+    """Helper function for the numerical rank of a triangular factor."""
+    diagonal = np.abs(np.diagonal(r))
+    if not diagonal.size:
+        return 0
+    tol = diagonal.max() * max(r.shape) * np.finfo(float).eps
+    return int((diagonal > tol).sum())
+
+
+def _sparse_gram_solver(gram_ss):
+    """Helper function that factors the Gram matrix of the sparse block of a
+    design, directly if it is diagonal and otherwise with a sparse LU
+    decomposition of it scaled to a unit diagonal. Raises LinAlgError if the
+    sparse columns are (numerically) collinear.
+
+    Arguments:
+        gram_ss - The Gram matrix of the sparse columns, in CSC format.
+
+    Returns:
+        A function that solves the Gram matrix for a vector or for the columns
+        of a matrix.
+    """
+    diag_ss = gram_ss.diagonal()
+    if (diag_ss == 0).any():
+        raise np.linalg.LinAlgError("Singular design matrix.")
+    if gram_ss.nnz == gram_ss.shape[0]:
+        def solve_ss(B):
+            return B / (diag_ss if B.ndim == 1 else diag_ss[:, np.newaxis])
+        return solve_ss
+
+    scale = np.sqrt(diag_ss)
+    inv_scale = sparse.diags(1 / scale)
+    try:
+        lu = splu((inv_scale @ gram_ss @ inv_scale).tocsc())
+    except RuntimeError:
+        # Raised by SuperLU for an exactly singular matrix
+        raise np.linalg.LinAlgError("Singular design matrix.")
+    # The scaled Gram matrix has a unit diagonal, so the pivots are relative
+    tol = np.finfo(np.float64).eps * gram_ss.shape[0]
+    if (np.abs(lu.U.diagonal()) <= tol).any():
+        raise np.linalg.LinAlgError("Singular design matrix.")
+
+    def solve_ss(B):
+        b_scale = scale if B.ndim == 1 else scale[:, np.newaxis]
+        return lu.solve(B / b_scale) / b_scale
+    return solve_ss
+
+
+def _sparse_gram_solve(solve_ss, W, schur_inv, B):
+    """Helper function that solves the Gram matrix of a sparse design by
+    block elimination, for the sparse block solved by solve_ss, W the sparse
+    block solved for the cross products and schur_inv the inverse of the
+    Schur complement of the sparse block."""
+    s = W.shape[0]
+    coef_d = schur_inv @ (B[s:] - W.T @ B[:s])
+    return np.concatenate((solve_ss(B[:s]) - W @ coef_d, coef_d))
+
+
+def _cholesky_solve(X, X_offsets, y):
+    """Helper function that solves a least squares problem through the
+    normal equations, with the Gram matrix scaled to a unit diagonal. X is
+    centered by X_offsets a block of rows at a time while the Gram matrix
+    is accumulated, so no centered copy of X is made.
+
+    Returns:
+        A tuple of an upper triangular r with r.T @ r == X.T @ X and the
+        coefficients, or None if X is too ill-conditioned for the normal
+        equations.
+    """
+    n, p = X.shape
+    if p == 0:
+        return None
+    X = np.asarray(X)
+    X_offsets = np.broadcast_to(np.asarray(X_offsets, dtype=np.float64), (p,))
+    gram = np.zeros((p, p))
+    Xy = np.zeros((p,) + y.shape[1:])
+    rows = max(1, _CHOLESKY_BLOCK_BYTES // (8 * p))
+    for start in range(0, n, rows):
+        block = np.asarray(X[start:start + rows], dtype=np.float64) - X_offsets
+        gram += np.dot(block.T, block)
+        Xy += np.dot(block.T, y[start:start + rows])
+    scale = np.sqrt(np.diagonal(gram))
+    if (scale == 0).any():
+        return None
+    try:
+        r = cholesky(gram / np.outer(scale, scale))
+    except np.linalg.LinAlgError:
+        return None
+    if np.linalg.cond(r) > _CHOLESKY_MAX_COND:
+        return None
+
+    if Xy.ndim == 1:
+        coef_ = cho_solve((r, False), Xy / scale) / scale
+    else:
+        coef_ = cho_solve((r, False), Xy / scale[:, np.newaxis]) / \
+            scale[:, np.newaxis]
+    return r * scale[np.newaxis, :], coef_
+
+
+def _centered_r(X, X_offsets, y):
+    """Helper function for the square triangular factor R of
+    [X - X_offsets, y] (y a 2D array), factored in place in one
+    Fortran-ordered buffer."""
+    n, p = X.shape
+    Z = np.empty((n, p + y.shape[1]), order="F")
+    np.subtract(X, X_offsets, out=Z[:, :p])
+    Z[:, p:] = y
+    if n < Z.shape[1]:
+        # Too few rows to hold the response block of R; pad with zero rows,
+        # which change neither r nor the coefficients
+        Z = np.vstack((Z, np.zeros((Z.shape[1] - n, Z.shape[1]))))
+    _, R = scipy.linalg.qr(
+        Z, mode="raw", overwrite_a=True, check_finite=False,
+    )
+    return R
+
+
+def _qr_solve_centered(X, X_offsets, y):
+    """Solve the least squares problem of X - X_offsets and y with a single
+    Householder QR of [X - X_offsets, y], never forming Q.
+
+    The centered design and the response are written into one
+    Fortran-ordered buffer that LAPACK factors in place, so the only copy
+    of the design made is the buffer itself.
+
+    Arguments:
+        X - The design matrix, which is not modified.
+        X_offsets - The column offsets to subtract from X (or 0).
+        y - The response vector or matrix.
+
+    Returns:
+        A tuple of an upper triangular r with r.T @ r equal to the Gram
+        matrix of the centered design and the coefficients.
+    """
+    n, p = X.shape
+    y_2d = y.reshape(n, -1)
+    R = _centered_r(X, X_offsets, y_2d)
+    r = R[:p, :p]
+    if p:
+        coef_ = solve_triangular(r, R[:p, p:], check_finite=False)
+    else:
+        coef_ = np.empty(shape=(0, y_2d.shape[1]))
+    if y.ndim == 1:
+        coef_ = coef_[:, 0]
+    return r, coef_
+
+
+_ColumnQR = namedtuple("_ColumnQR", ["terms", "columns", "q", "r"])
+_ColumnQR.__doc__ = """A full QR decomposition q @ r of some columns of a
+_DesignFactor (those of the named terms) followed by the response column."""
+
+
+class _DesignFactor:
+    """The triangular factor R of the centered [X, y] of a fitted model, where
+    X holds the columns of every explanatory term.
+
+    As R.T @ R is the Gram matrix of the centered design and response, any
+    model on a subset of the terms can be solved from the columns of R alone,
+    which are as short as the number of columns rather than the number of
+    rows. A model search keeps the QR decomposition of the columns of the
+    current model and scores adding or dropping a term with a column update
+    of it."""
+
+    def __init__(self, model):
+        """Create a _DesignFactor from a fitted (dense, single response)
+        LinearModel, evaluating its design once more."""
+        data = model.training_data
+        if data is None or model.multi_response:
+            raise NotImplementedError(
+                "A design factor needs a single response model that keeps "
+                "its training data."
+            )
+        self.data = data
+        self.re = model.re
+        self.terms = OrderedDict(
+            (str(term), term) for term in model.ex.get_terms()
+            if not isinstance(term, Constant)
+        )
+        blocks = [term.evaluate(data, fit=False) for term in self.terms.values()]
+        X = np.column_stack(
+            [np.empty((len(data), 0))] + [np.asarray(block) for block in blocks]
+        )
+        y = model.re.evaluate(data, fit=False)[:, :1]
+        self.n = len(data)
+
+        self.names = []
+        self.columns = {}
+        for name, block in zip(self.terms, blocks):
+            start = len(self.names)
+            self.names.extend(block.columns)
+            self.columns[name] = list(range(start, len(self.names)))
+
+        self.offsets = np.append(X.mean(axis=0), y.mean())
+        self.R = _centered_r(X, self.offsets[:-1], y - self.offsets[-1])
+
+    def qr(self, terms):
+        """Return the _ColumnQR of the columns of the given terms."""
+        names = [str(term) for term in terms]
+        columns = [column for name in names for column in self.columns[name]]
+        q, r = scipy.linalg.qr(
+            self.R[:, columns + [-1]], check_finite=False,
+        )
+        return _ColumnQR(names, columns, q, r)
+
+    def add(self, qr, term):
+        """Return the _ColumnQR of qr with the columns of a term appended,
+        by a column insertion update."""
+        name = str(term)
+        added = self.columns[name]
+        if not added:
+            return _ColumnQR(qr.terms + [name], qr.columns, qr.q, qr.r)
+        q, r = scipy.linalg.qr_insert(
+            qr.q, qr.r, self.R[:, added], len(qr.columns), which="col",
+            check_finite=False,
+        )
+        return _ColumnQR(qr.terms + [name], qr.columns + added, q, r)
+
+    def remove(self, qr, term):
+        """Return the _ColumnQR of qr without the columns of a term, by a
+        column deletion update."""
+        name = str(term)
+        removed = self.columns[name]
+        start = 0
+        for other in qr.terms[:qr.terms.index(name)]:
+            start += len(self.columns[other])
+        terms = [other for other in qr.terms if other != name]
+        columns = qr.columns[:start] + qr.columns[start + len(removed):]
+        if not removed:
+            return _ColumnQR(terms, columns, qr.q, qr.r)
+        q, r = scipy.linalg.qr_delete(
+            qr.q, qr.r, start, len(removed), which="col", check_finite=False,
+        )
+        return _ColumnQR(terms, columns, q, r)
+
+    def sse(self, qr):
+        """Return the sum of squared residuals of the model of a
+        _ColumnQR."""
+        k = len(qr.columns)
+        return qr.r[k, k] ** 2
+
+    def solution(self, qr):
+        """Return the arguments of LinearModel._finish_fit for the model of a
+        _ColumnQR: r, coef_, X_offsets, y_offset, sse, sst and cols."""
+        k = len(qr.columns)
+        r = qr.r[:k, :k]
+        if k:
+            coef_ = solve_triangular(r, qr.r[:k, k], check_finite=False)
+        else:
+            coef_ = np.empty(shape=0)
+        sst = (self.R[:, -1] ** 2).sum()
+        cols = [self.names[column] for column in qr.columns]
+        return (
+            r, coef_, self.offsets[qr.columns], self.offsets[-1],
+            self.sse(qr), sst, cols,
+        )
+
+
+def _qr_r(block):
+    """Helper function for the R factor of a block of rows."""
+    return np.linalg.qr(block, mode="r")
+
+
+def _tsqr(X, X_offsets, y, n_jobs=1):
+    """Helper function that solves a least squares problem with a tall-skinny
+    QR (TSQR) factorization: the R factors of blocks of rows of
+    [X - X_offsets, y] are computed independently (across a pool of
+    processes if n_jobs > 1) and then reduced pairwise in a tree.
+
+    Returns:
+        A tuple of an upper triangular r with r.T @ r equal to the Gram
+        matrix of the centered design and the coefficients.
+    """
+    n, p = X.shape
+    y_2d = y.reshape(n, -1)
+    if p == 0:
+        coef_ = np.empty(shape=(0, y_2d.shape[1]))
+        return np.empty(shape=(0, 0)), coef_[:, 0] if y.ndim == 1 else coef_
+
+    # The centered design and the response share one buffer
+    Z = np.empty((n, p + y_2d.shape[1]))
+    Z[:, :p] = X
+    Z[:, :p] -= X_offsets
+    Z[:, p:] = y_2d
+    n_blocks = max(n_jobs, -(-n // _TSQR_BLOCK_ROWS))
+    blocks = np.array_split(Z, n_blocks)
+
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            factors = list(executor.map(_qr_r, blocks))
+    else:
+        factors = [_qr_r(block) for block in blocks]
+
+    while len(factors) > 1:
+        factors = [
+            _qr_r(np.vstack(factors[i:i + 2]))
+            for i in range(0, len(factors), 2)
+        ]
+    R = factors[0]
+
+    r = R[:p, :p]
+    coef_ = solve_triangular(r, R[:p, p:])
+    if y.ndim == 1:
+        coef_ = coef_[:, 0]
+    return r, coef_
+
+
+def _sketch_solve(X, y, random_state=0):
+    """Helper function that solves a least squares problem by sketch and
+    precondition (as in Blendenpik): the R factor of a sparse random sketch
+    (CountSketch) of X is used as a right preconditioner for LSQR, which then
+    converges to the exact solution in a few iterations.
+
+    Returns:
+        A tuple of an upper triangular r with r.T @ r == X.T @ X, the
+        coefficients and a dictionary of the number of LSQR iterations and
+        the residual norm (lists for multiple responses).
+    """
+    X = np.asarray(X)
+    n, p = X.shape
+    if p == 0:
+        # Nothing to solve, the residuals are y itself
+        norms = list(np.linalg.norm(y.reshape(n, -1), axis=0))
+        info = dict(iterations=[0] * len(norms), residual_norm=norms,
+                    sketch_rows=0)
+        coef_ = np.empty(shape=(0, len(norms)))
+        if y.ndim == 1:
+            coef_ = coef_[:, 0]
+            info["iterations"] = 0
+            info["residual_norm"] = norms[0]
+        return np.empty(shape=(0, 0)), coef_, info
+    rng = np.random.RandomState(random_state)
+
+    # Hash every row into one of m rows of the sketch with a random sign
+    m = min(n, max(_SKETCH_FACTOR * p, p + 1))
+    sketch = sparse.csr_matrix(
+        (rng.choice([-1.0, 1.0], n), (rng.randint(m, size=n), np.arange(n))),
+        shape=(m, n),
+    )
+    q_sketch, R = np.linalg.qr(sketch @ X)
+
+    def solve_R(v):
+        return solve_triangular(R, v)
+
+    def solve_RT(v):
+        return solve_triangular(R, v, trans="T")
+
+    preconditioned = LinearOperator(
+        (n, p),
+        matvec=lambda v: np.dot(X, solve_R(v)),
+        rmatvec=lambda v: solve_RT(np.dot(X.T, v)),
+        dtype=float,
+    )
+
+    Y = y.reshape(n, -1)
+    sketch_Y = sketch @ Y
+    coef_ = np.empty((p, Y.shape[1]))
+    info = dict(iterations=[], residual_norm=[], sketch_rows=m)
+    for j in range(Y.shape[1]):
+        # Warm start from the sketched solution
+        start = np.dot(q_sketch.T, sketch_Y[:, j])
+        result = lsqr(
+            preconditioned,
+            Y[:, j],
+            atol=_SKETCH_TOL,
+            btol=_SKETCH_TOL,
+            iter_lim=10 * p + 100,
+            x0=start,
+        )
+        coef_[:, j] = solve_R(result[0])
+        info["iterations"].append(result[2])
+        info["residual_norm"].append(result[3])
+
+    # X R^-1 is well-conditioned, so its Gram matrix can be factored safely
+    gram = np.zeros((p, p))
+    chunk_rows = max(1, _INTERVAL_CHUNK_BYTES // (8 * max(p, 1)))
+    for start in range(0, n, chunk_rows):
+        block = solve_RT(X[start:start + chunk_rows].T)
+        gram += np.dot(block, block.T)
+    r = np.dot(cholesky(gram), R)
+
+    if y.ndim == 1:
+        coef_ = coef_[:, 0]
+        info["iterations"] = info["iterations"][0]
+        info["residual_norm"] = info["residual_norm"][0]
+    return r, coef_, info
+
+
+def _cov_factor(cov):
+    """Helper function for a factor F of a covariance matrix with
+    cov == F @ F.T: its lower Cholesky factor, or a factor from its
+    eigendecomposition if it is not positive definite."""
+    try:
+        return np.linalg.cholesky(cov)
+    except np.linalg.LinAlgError:
+        values, vectors = np.linalg.eigh(cov)
+        return vectors * np.sqrt(np.clip(values, 0, None))
+
+
+def _row_quad_forms(X, factor):
+    """Helper function for the quadratic forms x @ cov @ x of the rows of X,
+    as the squared norms of the rows of X @ factor, a chunk at a time so the
+    temporary stays small."""
+    X = np.asarray(X, dtype=float)
+    n, p = X.shape
+    chunk_rows = max(1, _INTERVAL_CHUNK_BYTES // (8 * max(p, 1)))
+    quad = np.empty(n)
+    for start in range(0, n, chunk_rows):
+        block = np.dot(X[start:start + chunk_rows], factor)
+        quad[start:start + chunk_rows] = np.einsum("ij,ij->i", block, block)
+    return quad
+
+
+@lru_cache(maxsize=256)
+def _t_critical(prob, df):
+    """Helper function for a cached quantile of the t distribution."""
+    return stats.t.ppf(prob, df)
+
+
+@lru_cache(maxsize=256)
+def _f_critical(prob, dfn, dfd):
+    """Helper function for a cached quantile of the F distribution."""
+    return stats.f.ppf(prob, dfn, dfd)
+
+
+FittedState = namedtuple("FittedState", [
+    "ex",
+    "intercept",
+    "sparse",
+    "coef",
+    "cov",
+    "cov_factor",
+    "rdf",
+    "resid_var",
+    "response_names",
+    "fixed_effects",
+])
+FittedState.__doc__ = """An immutable snapshot of everything a fitted
+LinearModel needs to predict: a frozen copy of the explanatory Expression
+(with its Categorical levels and transformation parameters), read-only copies
+of the coefficients, their covariance matrix and a triangular factor of it
+(for interval widths), and the residual variance.
+Refitting a model replaces its snapshot rather than changing it, so
+predictions can run concurrently with each other and with a refit."""
+
+
+class FitSummary(namedtuple("FitSummary", [
+    "n",
+    "p",
+    "sse",
+    "sst",
+    "rank",
+    "rdf",
+])):
+    """The sufficient statistics of a fit that model selection metrics are
+    computed from: the number of rows and of design columns (not including
+    the intercept), the sums of squared residuals and of squares about the
+    mean, the numerical rank of the design (including the intercept) and
+    the residual degrees of freedom. It is produced once per fit (see
+    LinearModel.summary_), so scoring a fit costs the same for any number
+    of rows."""
+
+    __slots__ = ()
+
+    @property
+    def resid_var(self):
+        """The residual variance."""
+        return self.sse / self.rdf
+
+    def log_likelihood(self):
+        """The Gaussian log likelihood of the fit at its residual
+        variance."""
+        resid_var = self.resid_var
+        return (-self.n / 2 * (np.log(2 * np.pi) + np.log(resid_var)) -
+                (1 / (2 * resid_var)) * self.sse)
+
+
 class Model:
     """A general Model class that both Linear models and (in the future)
     General Linear models stem from."""
@@ -121,23 +929,108 @@ class LinearModel(Model):
     """A specific Model that assumes the response variable is linearly related
     to the explanatory variables."""
 
-    def __init__(self, explanatory, response, intercept=True):
+    # The inference of a lean fit, computed on first access of any of the
+    # attributes below (once, by whichever thread gets there first)
+    _pending_inference = None
+    _building_inference = False
+    cov_ = _lazy_inference("cov_")
+    se_coef_ = _lazy_inference("se_coef_")
+    t_ = _lazy_inference("t_")
+    p_ = _lazy_inference("p_")
+    table_ = _lazy_inference("table_")
+    state_ = _lazy_inference("state_")
+
+    def __init__(
+        self,
+        explanatory,
+        response,
+        intercept=True,
+        multi_output=False,
+        sparse=False,
+        absorb=None,
+        solver="auto",
+        n_jobs=1,
+        random_state=0,
+        dtype=np.float64,
+    ):
         """Create a LinearModel object.
 
         An intercept is included in the model by default. To fit a model
         without an intercept term, either set intercept=False or subtract '1'
         from the explanatory Expression.
 
+        Several responses can be fit against the same explanatory Expression
+        at once by giving a list of response Expressions (or a Combination
+        with multi_output=True). The design matrix is then evaluated and
+        factorized a single time for all of them.
+
         Arguments:
             explanatory - An Expression that is either a single term or a
                 Combination of terms. These are the X's.
             response - An Expression that represents the single term for the
                 response variables. This is the y. If this is a Combination,
                 the terms will be added together and treated as a single
-                variable.
+                variable. If this is a list of Expressions, each is treated
+                as a separate response.
             intercept - A boolean indicating whether an intercept should be
                 included (True) or not (False).
+            multi_output - A boolean indicating whether the terms of a
+                Combination response should be treated as separate responses
+                (True) or added together (False). Default is False.
+            sparse - A boolean indicating whether the design matrix should be
+                kept sparse (True), which is far cheaper for Categorical
+                variables with many levels, or dense (False). A sparse fit
+                solves the normal equations in float64 itself, so solver and
+                dtype must be left at their defaults. Default is False.
+            absorb - An optional Categorical (or a Combination of them) of
+                nuisance factors, such as an ID with many levels, whose fixed
+                effects are swept out of the response and the explanatory
+                columns instead of being encoded. Only the coefficients of
+                the explanatory Expression are estimated. The fixed effects
+                take the place of the intercept. The degrees of freedom they
+                use are exact, but for three or more factors every connected
+                group of levels (those linked through shared observations)
+                can have at most 4000 levels. Default is None.
+            solver - The method used to solve the least squares problem:
+                'qr' (a QR decomposition of the design matrix), 'cholesky'
+                (a Cholesky decomposition of the normal equations, faster
+                and lighter on memory for tall designs with few columns),
+                'tsqr' (a QR decomposition of blocks of rows, which can use
+                several processes), 'sketch' (LSQR preconditioned with a
+                random sketch of the design matrix, see solver_info_ for the
+                iterations and residual norm) or 'auto' (Cholesky for at
+                least 100,000 rows and at most 200 columns, QR otherwise).
+                Cholesky falls back to QR when the design matrix is
+                ill-conditioned.
+                Default is 'auto'.
+            n_jobs - The number of processes used by the 'tsqr' solver. A
+                value of -1 uses every CPU. Default is 1.
+            random_state - The seed of the random sketch of the 'sketch'
+                solver. Default is 0.
+            dtype - The precision in which the design matrix (X_train_),
+                the fitted values and the residuals are stored: np.float64
+                or np.float32, which halves their memory. Means, sums of
+                squares and the factorization are always accumulated in
+                float64, so a float32 fit is the exact fit of a design whose
+                entries are rounded by a relative 6e-8 at most; its
+                coefficients agree with a float64 fit to a relative error of
+                roughly 6e-8 times the condition number of the design.
+                Default is np.float64.
         """
+        if solver not in ("qr", "cholesky", "tsqr", "sketch", "auto"):
+            raise ValueError(
+                "Unknown solver {}, expected 'qr', 'cholesky', 'tsqr', "
+                "'sketch' or 'auto'.".format(solver)
+            )
+        self.solver = solver
+        self.random_state = random_state
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.float32, np.float64):
+            raise ValueError(
+                "Unknown dtype {}, expected float32 or float64.".format(dtype)
+            )
+        self.n_jobs = os.cpu_count() if n_jobs == -1 else max(1, n_jobs)
+
         if explanatory is None:
             explanatory = 0
 
@@ -160,10 +1053,39 @@ class LinearModel(Model):
             # a wanted intercept
             self.given_ex = self.given_ex - constant
 
+        # The intercept is part of the absorbed fixed effects
+        self.absorb = None
+        if absorb is not None:
+            self.absorb = [term.name for term in absorb.get_terms()]
+            self.intercept = False
+        self.absorbed_df_ = 0
+
+        if multi_output and isinstance(response, Combination):
+            response = sorted(response.get_terms(), key=str)
+        self.multi_response = isinstance(response, (list, tuple))
+
         # This will collapse any combination of variables into a single column
-        self.given_re = Identity(response)
+        if self.multi_response:
+            self.given_re = [Identity(term) for term in response]
+        else:
+            self.given_re = Identity(response)
+        self.sparse = sparse
+        if self.sparse and self.multi_response:
+            raise NotImplementedError(
+                "Sparse fits are not supported for multiple responses."
+            )
+        if self.sparse and self.absorb is not None:
+            raise NotImplementedError(
+                "Sparse fits are not supported with absorbed factors."
+            )
+        if self.sparse and (solver != "auto" or self.dtype != np.float64):
+            raise NotImplementedError(
+                "Sparse fits solve the normal equations in float64; solver "
+                "and dtype cannot be set."
+            )
         self.ex = None
         self.re = None
+        self._inference_lock = threading.RLock()
 
         self.training_data = None
 
@@ -171,12 +1093,16 @@ class LinearModel(Model):
 
     def __str__(self):
         """Convert a LinearModel to a str format for printing."""
+        if self.multi_response:
+            response = ", ".join(str(term) for term in self.given_re)
+        else:
+            response = str(self.given_re)
         if self.intercept:
-            return str(self.given_re) + " ~ " + str(1 + self.given_ex)
+            return response + " ~ " + str(1 + self.given_ex)
         else:
-            return str(self.given_re) + " ~ " + str(self.given_ex)
+            return response + " ~ " + str(self.given_ex)
 
-    def fit(self, X, y=None):
+    def fit(self, X, y=None, lean=False, keep_data=True):
         """Fit a LinearModel to data..
 
         Data can either be provided as a single DataFrame X that contains both
@@ -192,85 +1118,539 @@ class LinearModel(Model):
             X - A DataFrame containing all of the explanatory variables in the
                 model and possibly the response variable too.
             y - An optional Series that contains the response variable.
+            lean - If True, only the coefficients, SSE and rank are computed
+                by the fit. The covariance matrix, standard errors, p-values
+                and table_ are computed the first time one of them is
+                accessed. Meant for the many throwaway fits of a model
+                search. Default is False.
+            keep_data - If False, the model is slimmed after fitting (see
+                LinearModel.slim). Default is True.
 
         Returns:
             A DataFrame containing relevant statistics of fitted Model (e.g.,
-            coefficients, p-values).
+            coefficients, p-values), or None for a lean fit.
         """
         if y is None:
             data = X
         else:
             data = pd.concat([X, y], axis=1)
-        return self._fit(data)
+        table = self._fit(data, lean)
+        if not keep_data:
+            self.slim()
+        return table
 
-    def _fit(self, data):
+    def slim(self):
+        """Drop the references a fitted LinearModel keeps to the data it was
+        fit on (training_data, X_train_, y_train_, fitted_ and residuals_),
+        so that many fitted models can be held at once.
+
+        The coefficients, their covariance matrix, the Categorical levels,
+        the transformation parameters and the sums of squares are kept, so
+        a slim model can still predict (with intervals), give confidence
+        intervals, be compared with anova to another model and give its
+        likelihood. Plots and methods that refit on the training data need
+        the data and are not available.
+
+        Returns:
+            The LinearModel itself.
+        """
+        self.training_data = None
+        self.X_train_ = None
+        self.y_train_ = None
+        self.fitted_ = None
+        self.residuals_ = None
+        return self
+
+    def _fit(self, data, lean=False):
 
         # Initialize the categorical levels
         self.categorical_levels = dict()
         self.training_data = data
+        self._moments = None
+        self._factor = None
 
         # Replace all Var's with either Q's or C's
-        self.re = self.given_re.copy().interpret(data)
+        if self.multi_response:
+            self.re = [term.copy().interpret(data) for term in self.given_re]
+        else:
+            self.re = self.given_re.copy().interpret(data)
         self.ex = self.given_ex.copy().interpret(data)
 
         # Construct X matrix
-        X = self.ex.evaluate(data)
+        if self.sparse:
+            X = self.ex.evaluate_sparse(data)
+        elif isinstance(self.ex, Combination):
+            X = self.ex.evaluate(data, dtype=self.dtype)
+        else:
+            X = self.ex.evaluate(data).astype(self.dtype, copy=False)
         self.X_train_ = X
-        # Construct y vector
-        y = self.re.evaluate(data)[:, 0]
+        # Construct y vector (or matrix, one column per response)
+        if self.multi_response:
+            y = np.column_stack([term.evaluate(data)[:, 0] for term in self.re])
+        else:
+            y = self.re.evaluate(data)[:, 0]
         self.y_train_ = y
 
+        if self.sparse:
+            return self._fit_sparse(X, y, lean)
+
+        if self.absorb is not None:
+            return self._fit_absorbed(data, X, y, lean)
+
         # Get dimensions
         self.n, self.p = X.shape
 
-        # Center if there is an intercept
+        # Center if there is an intercept; X_train_ itself is left as is and
+        # the centering happens in the solver's own buffer
         if self.intercept:
-            X_offsets = X.mean(axis=0)
-            y_offset = y.mean()
-            X -= X_offsets[np.newaxis, :]
+            X_offsets = np.asarray(X.mean(axis=0, dtype=np.float64))
+            y_offset = y.mean(axis=0)
         else:
-            X_offsets = 0
+            X_offsets = np.zeros(self.p)
             y_offset = 0
 
-        # Get coefficients using QR decomposition
-        q, r = np.linalg.qr(X)
-        coef_ = qr_solve(q, r, y - y_offset)
+        # Get coefficients
+        r, coef_ = self._solve(X, X_offsets, y - y_offset)
         cols = X.columns.copy()  # column names
+        self._design_columns = cols
 
-        # Get fitted values and residuals
-        self.fitted_ = y_offset + np.dot(X, coef_)
-        self.residuals_ = y - self.fitted_
+        # Get fitted values and residuals (in float64, then stored in the
+        # model's precision)
+        fitted = y_offset - np.dot(X_offsets, coef_) + np.dot(X, coef_)
+        residuals = y - fitted
+        self.fitted_ = fitted.astype(self.dtype, copy=False)
+        self.residuals_ = residuals.astype(self.dtype, copy=False)
+
+        sse = (residuals ** 2).sum(axis=0)
+        sst = ((y - y.mean(axis=0)) ** 2).sum(axis=0)
+
+        return self._finish_fit(
+            r, coef_, X_offsets, y_offset, sse, sst, cols, lean,
+        )
+
+    def _finish_fit(
+        self, r, coef_, X_offsets, y_offset, sse, sst, cols, lean=False,
+    ):
+        """Helper function that turns a solved (centered) least squares
+        problem into the residual variance, the covariance matrix and the
+        output table. Shared by every fitting strategy.
+
+        Arguments:
+            r - The upper triangular factor of the (centered) design matrix,
+                i.e. r.T @ r == X.T @ X.
+            coef_ - The solved coefficients, not including the intercept. A
+                2D array with a column per response for multiple responses.
+            X_offsets - The column means of the design matrix (0 if there is
+                no intercept).
+            y_offset - The mean of the response (0 if there is no intercept).
+            sse - The sum of squared residuals.
+            sst - The total sum of squares of the response.
+            cols - The column names of the design matrix.
+            lean - If True, only the coefficients are set and the rest of the
+                inference is deferred to _build_inference. Default is False.
+
+        Returns:
+            A DataFrame containing relevant statistics of fitted Model, or
+            None if lean.
+        """
+        cols = list(cols)
+        self._sse = sse
+        self._sst = sst
 
         # Get residual variance
         self.rdf = self.n - self.p - (1 if self.intercept else 0)
-        self.resid_var_ = (self.residuals_ ** 2).sum() / self.rdf
-
-        # Get covariance matrix between coefficients
-        self.cov_ = self.resid_var_ * cho_inv(r)
+        self.rdf -= self.absorbed_df_
+        self.resid_var_ = sse / self.rdf
+        self.rank_ = _rank(r) + (1 if self.intercept else 0)
+        self.summary_ = FitSummary(
+            self.n, self.p, sse, sst, self.rank_, self.rdf,
+        )
 
-        # Update coefficients and covariance matrix with intercept
-        # (if applicable)
+        # Update coefficients with intercept (if applicable)
         if self.intercept:
             cols.append("Intercept")
-            coef_ = np.append(coef_, y_offset - (X_offsets * coef_).sum())
-            cov_coef_intercept = -1*np.dot(self.cov_, X_offsets)
+            coef_ = np.concatenate(
+                (coef_, [y_offset - np.dot(X_offsets, coef_)])
+            )
+
+        self._pending_inference = (
+            "_dense_inference", (r, coef_, X_offsets, cols),
+        )
+        if not lean:
+            return self._build_inference()
+
+        if self.multi_response:
+            self.coef_ = pd.DataFrame(
+                coef_, index=cols, columns=[str(term) for term in self.re],
+            )
+        else:
+            self.coef_ = pd.Series(coef_, index=cols, name="Coefficient")
+
+    def __getstate__(self):
+        # Locks cannot be pickled, a new one is made on unpickling
+        state = self.__dict__.copy()
+        state.pop("_inference_lock", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._inference_lock = threading.RLock()
+
+    def _build_inference(self):
+        """Helper function that computes the covariance matrix, standard
+        errors and output table of the fit set aside by _finish_fit.
+
+        Returns:
+            A DataFrame containing relevant statistics of fitted Model, or
+            None if it was already built.
+        """
+        with self._inference_lock:
+            if self._pending_inference is None or self._building_inference:
+                # Built by another thread while waiting for the lock, or
+                # being built by this one (which reads what it has set)
+                return None
+            self._building_inference = True
+            try:
+                name, args = self._pending_inference
+                table = getattr(self, name)(*args)
+                # Only cleared once every attribute is set, as other threads
+                # read them without the lock once it is
+                self._pending_inference = None
+                return table
+            finally:
+                self._building_inference = False
+
+    def _dense_inference(self, r, coef_, X_offsets, cols):
+        """Helper function for _build_inference of a dense fit, run under
+        its lock, from the triangular factor r of the centered design."""
+        # Get covariance matrix between coefficients, up to the residual
+        # variance (which is all that differs between multiple responses)
+        unscaled_cov = cho_inv(r)
+
+        # Update covariance matrix with intercept (if applicable)
+        if self.intercept:
+            cov_coef_intercept = -1*np.dot(unscaled_cov, X_offsets)
 
-            var_intercept = self.resid_var_ / self.n
+            var_intercept = 1 / self.n
             var_intercept -= (X_offsets * cov_coef_intercept).sum()
 
-            self.cov_ = np.block([
-                [self.cov_, cov_coef_intercept[:, np.newaxis]],
+            unscaled_cov = np.block([
+                [unscaled_cov, cov_coef_intercept[:, np.newaxis]],
                 [cov_coef_intercept[np.newaxis, :], var_intercept]
             ])
 
         # Get standard errors (diagonal of the covariance matrix)
-        se_coef_ = np.sqrt(np.diagonal(self.cov_))
+        if self.multi_response:
+            self.cov_ = self.resid_var_[:, np.newaxis, np.newaxis] * \
+                unscaled_cov[np.newaxis, :, :]
+            se_coef_ = np.sqrt(
+                np.outer(np.diagonal(unscaled_cov), self.resid_var_)
+            )
+        else:
+            self.cov_ = self.resid_var_ * unscaled_cov
+            se_coef_ = np.sqrt(np.diagonal(self.cov_))
+
+        return self._inference_table(coef_, se_coef_, cols)
 
+    def _solve(self, X, X_offsets, y):
+        """Helper function that solves the least squares problem of a
+        design matrix centered by X_offsets with the chosen solver.
+
+        Arguments:
+            X - The (uncentered) design matrix, which is not modified.
+            X_offsets - The column offsets to subtract from X.
+            y - The (centered) response vector or matrix.
+
+        Returns:
+            A tuple of an upper triangular r with r.T @ r == X.T @ X and the
+            coefficients.
+        """
+        solver = self.solver
+        n, p = X.shape
+        if solver == "auto":
+            if n >= _CHOLESKY_MIN_ROWS and p <= _CHOLESKY_MAX_COLS:
+                solver = "cholesky"
+            else:
+                solver = "qr"
+
+        if solver == "qr":
+            self.solver_ = "qr"
+            return _qr_solve_centered(X, X_offsets, y)
+
+        if solver == "cholesky":
+            solution = _cholesky_solve(X, X_offsets, y)
+            if solution is not None:
+                self.solver_ = "cholesky"
+                return solution
+
+        if solver == "tsqr":
+            self.solver_ = "tsqr"
+            return _tsqr(X, X_offsets, y, self.n_jobs)
+
+        if solver == "sketch":
+            self.solver_ = "sketch"
+            r, coef_, self.solver_info_ = _sketch_solve(
+                X - X_offsets,
+                y,
+                self.random_state,
+            )
+            return r, coef_
+
+        self.solver_ = "qr"
+        return _qr_solve_centered(X, X_offsets, y)
+
+    def _fit_absorbed(self, data, X, y, lean=False):
+        """Helper function that fits a model with absorbed factors by
+        sweeping their group means out of X and y (the within
+        transformation) and solving the reduced least squares problem.
+
+        Arguments:
+            data - The DataFrame being fit, holding the absorbed factors.
+            X - The design matrix of the explanatory Expression.
+            y - The response vector (or matrix for multiple responses).
+            lean - Whether to defer the inference (see fit).
+
+        Returns:
+            A DataFrame containing relevant statistics of fitted Model.
+        """
+        codes = []
+        levels = []
+        for name in self.absorb:
+            code, level = pd.factorize(data[name])
+            if (code < 0).any():
+                raise ValueError(
+                    "Absorbed factor {} has missing values.".format(name)
+                )
+            codes.append(code)
+            levels.append(level)
+        self.absorbed_df_ = _absorbed_df(codes)
+
+        self.n, self.p = X.shape
+        cols = X.columns.copy()
+        self._design_columns = cols
+        y_2d = y.reshape(self.n, -1)
+        Z = np.hstack((np.asarray(X, dtype=float), y_2d))
+        removed = _sweep_groups(Z, codes)
+        X_within, y_within = Z[:, :self.p], Z[:, self.p:]
+
+        r, coef_ = self._solve(X_within, 0, y_within)
+        residuals = y_within - np.dot(X_within, coef_)
+
+        # The fixed effects of y - X coef follow from the removed means, as
+        # the sweeps are linear
+        weights = np.vstack((-coef_, np.eye(y_2d.shape[1])))
+        self.fixed_effects_ = {
+            name: pd.DataFrame(np.dot(total, weights), index=level)
+            for name, total, level in zip(self.absorb, removed, levels)
+        }
+
+        if not self.multi_response:
+            coef_ = coef_[:, 0]
+            residuals = residuals[:, 0]
+            self.fixed_effects_ = {
+                name: effects[0]
+                for name, effects in self.fixed_effects_.items()
+            }
+        self.residuals_ = residuals.astype(self.dtype, copy=False)
+        self.fitted_ = (y - residuals).astype(self.dtype, copy=False)
+
+        sse = (residuals ** 2).sum(axis=0)
+        sst = ((y - y.mean(axis=0)) ** 2).sum(axis=0)
+
+        return self._finish_fit(r, coef_, 0, 0, sse, sst, cols, lean)
+
+    def _fit_sparse(self, X, y, lean=False):
+        """Helper function that fits a sparse design matrix by solving the
+        normal equations.
+
+        The columns are split into the sparse (mostly zero) ones, typically
+        Categorical indicators, and the few dense ones plus the intercept.
+        Only the dense columns are centered, and the normal equations are
+        solved by block elimination through the Schur complement of the
+        sparse block. The Gram matrix of the sparse block is often diagonal
+        (e.g. the levels of a single Categorical), otherwise it is factored
+        with a sparse LU decomposition. The full covariance matrix is only
+        stored when there are at most _SPARSE_COV_MAX coefficients; otherwise
+        cov_ is None and only the standard errors are computed. A rank
+        deficient design raises LinAlgError, as the block elimination needs
+        both the sparse block and its Schur complement to be nonsingular.
+
+        Arguments:
+            X - A sparse design matrix from Expression.evaluate_sparse.
+            y - The response vector.
+            lean - If True, the standard errors and covariance matrix are
+                deferred to _build_inference. Default is False.
+
+        Returns:
+            A DataFrame containing relevant statistics of fitted Model, or
+            None if lean.
+        """
+        cols = list(X.columns)
+        X = X.tocsc()
+        self.n, self.p = X.shape
+        self._design_columns = cols
+
+        # Split off (and center) the dense columns, followed by the intercept
+        dense = np.diff(X.indptr) > self.n / 2
+        order = np.concatenate((np.flatnonzero(~dense), np.flatnonzero(dense)))
+        S = X[:, ~dense]
+        D = X[:, dense].toarray()
+        X_offsets = np.zeros(D.shape[1])
+        if self.intercept:
+            X_offsets = D.mean(axis=0)
+            D = np.hstack((D - X_offsets, np.ones((self.n, 1))))
+        s, k = S.shape[1], S.shape[1] + D.shape[1]
+
+        gram_ss = (S.T @ S).tocsc()
+        gram_sd = np.asarray(S.T @ D)
+        gram_dd = D.T @ D
+
+        solve_ss = _sparse_gram_solver(gram_ss)
+
+        # Schur complement of the sparse block, scaled to a unit diagonal to
+        # check that the dense columns are not in the span of the sparse ones
+        W = solve_ss(gram_sd)
+        schur = gram_dd - gram_sd.T @ W
+        schur_scale = np.sqrt(np.diagonal(gram_dd))
+        if not (schur_scale > 0).all() or np.linalg.matrix_rank(
+            schur / np.outer(schur_scale, schur_scale),
+            tol=np.finfo(np.float64).eps * k,
+        ) < schur.shape[0]:
+            raise np.linalg.LinAlgError("Singular design matrix.")
+        schur_inv = np.linalg.inv(schur)
+
+        coef_A = _sparse_gram_solve(
+            solve_ss, W, schur_inv, np.concatenate((S.T @ y, D.T @ y)),
+        )
+        self.fitted_ = S @ coef_A[:s] + D @ coef_A[s:]
+        self.residuals_ = y - self.fitted_
+        sse = (self.residuals_ ** 2).sum()
+        sst = ((y - y.mean()) ** 2).sum()
+
+        self._sse = sse
+        self._sst = sst
+        self.rdf = self.n - self.p - (1 if self.intercept else 0)
+        self.resid_var_ = sse / self.rdf
+        # Full rank, as a singular design has raised above
+        self.rank_ = k
+        self.summary_ = FitSummary(
+            self.n, self.p, sse, sst, self.rank_, self.rdf,
+        )
+
+        # Map back to the original columns, a permutation of the columns
+        # plus the intercept, which absorbs the offsets of the centered
+        # columns (applied by indexing, as k may be in the tens of thousands)
+        coef_ = np.empty(k)
+        coef_[order] = coef_A[:self.p]
+        if self.intercept:
+            cols.append("Intercept")
+            coef_[-1] = coef_A[-1] - np.dot(X_offsets, coef_A[s:self.p])
+
+        if not lean:
+            # Also drops what an earlier lean fit may have set aside
+            self._pending_inference = None
+            return self._sparse_inference(
+                gram_ss, W, schur_inv, order, X_offsets, coef_, cols,
+                solve_ss,
+            )
+
+        # The factorization of the sparse block is not kept, a lean fit
+        # refactors it if its inference is ever built
+        self._pending_inference = (
+            "_sparse_inference",
+            (gram_ss, W, schur_inv, order, X_offsets, coef_, cols),
+        )
+        self.coef_ = pd.Series(coef_, index=cols, name="Coefficient")
+
+    def _sparse_inference(self, gram_ss, W, schur_inv, order, X_offsets,
+                          coef_, cols, solve_ss=None):
+        """Helper function for _build_inference of a sparse fit, run under
+        its lock, from the block elimination set aside by _fit_sparse."""
+        if solve_ss is None:
+            solve_ss = _sparse_gram_solver(gram_ss)
+        s, k = gram_ss.shape[0], len(coef_)
+
+        # Diagonal of the inverse Gram matrix of the sparse block, solved
+        # for a block of unit vectors at a time
+        if gram_ss.nnz == s:
+            inv_diag_ss = 1 / gram_ss.diagonal()
+        else:
+            inv_diag_ss = np.empty(s)
+            for start in range(0, s, _SPARSE_BLOCK):
+                idx = np.arange(start, min(start + _SPARSE_BLOCK, s))
+                unit = np.zeros((s, len(idx)))
+                unit[idx, np.arange(len(idx))] = 1
+                inv_diag_ss[idx] = solve_ss(unit)[idx, np.arange(len(idx))]
+
+        # Diagonal of the inverse Gram matrix
+        unscaled_var = np.concatenate((
+            inv_diag_ss + ((W @ schur_inv) * W).sum(axis=1),
+            np.diagonal(schur_inv),
+        ))
+
+        def gram_solve(B):
+            return _sparse_gram_solve(solve_ss, W, schur_inv, B)
+
+        def to_original(B):
+            B_orig = np.empty_like(B)
+            B_orig[order] = B[:self.p]
+            if self.intercept:
+                B_orig[-1] = B[-1] - np.dot(X_offsets, B[s:self.p])
+            return B_orig
+
+        var_ = np.empty(k)
+        var_[order] = unscaled_var[:self.p]
+        if self.intercept:
+            intercept_row = np.zeros(k)
+            intercept_row[-1] = 1
+            intercept_row[s:self.p] = -X_offsets
+            var_[-1] = np.dot(intercept_row, gram_solve(intercept_row))
+
+        if k <= _SPARSE_COV_MAX:
+            unscaled_cov = to_original(to_original(gram_solve(np.eye(k))).T)
+            self.cov_ = self.resid_var_ * unscaled_cov
+        else:
+            self.cov_ = None
+        se_coef_ = np.sqrt(self.resid_var_ * var_)
+
+        return self._inference_table(coef_, se_coef_, cols)
+
+    def _inference_table(self, coef_, se_coef_, cols):
+        """Helper function that computes the t statistics, p-values and
+        confidence intervals of the coefficients and collects them in the
+        output table.
+
+        Arguments:
+            coef_ - The coefficients, including the intercept. A 2D array with
+                a column per response for multiple responses.
+            se_coef_ - The standard errors of the coefficients.
+            cols - The names of the coefficients.
+
+        Returns:
+            A DataFrame containing relevant statistics of fitted Model.
+        """
         # Get inference for coefficients
         self.t_ = coef_ / se_coef_
         self.p_ = 2 * stats.t.cdf(-abs(self.t_), self.rdf)
         lower_bound, upper_bound = _confint(coef_, se_coef_, self.rdf, .975)
 
+        if self.multi_response:
+            # Stack the responses into a single (response, term) panel
+            names = [str(term) for term in self.re]
+            table = pd.DataFrame(OrderedDict((
+                ("Coefficient", coef_.T.ravel()), ("SE", se_coef_.T.ravel()),
+                ("t", self.t_.T.ravel()), ("p", self.p_.T.ravel()),
+                ("2.5%", lower_bound.T.ravel()),
+                ("97.5%", upper_bound.T.ravel())
+            )), index=pd.MultiIndex.from_product([names, cols]))
+
+            self.coef_ = pd.DataFrame(coef_, index=cols, columns=names)
+            self.se_coef_ = pd.DataFrame(se_coef_, index=cols, columns=names)
+            self.table_ = table
+            self._freeze_state()
+
+            return table
+
         # Create output table
         table = pd.DataFrame(OrderedDict((
             ("Coefficient", coef_), ("SE", se_coef_),
@@ -280,9 +1660,318 @@ class LinearModel(Model):
 
         self.coef_ = table["Coefficient"]
         self.se_coef_ = table["SE"]
+        self.table_ = table
+        self._freeze_state()
 
         return table
 
+    def _freeze_state(self):
+        """Helper function to take the immutable snapshot of a fit used for
+        predicting (see FittedState)."""
+        if self.multi_response:
+            response_names = tuple(str(term) for term in self.re)
+        else:
+            response_names = (str(self.re),)
+        fixed_effects = None
+        if self.absorb is not None:
+            fixed_effects = tuple(
+                (name, effects.index.copy(), _read_only(effects.values))
+                for name, effects in self.fixed_effects_.items()
+            )
+        cov_factor = None
+        if self.cov_ is not None and not self.multi_response:
+            cov_factor = _read_only(_cov_factor(self.cov_))
+        self.state_ = FittedState(
+            ex=self.ex.freeze(),
+            intercept=self.intercept,
+            sparse=self.sparse,
+            coef=_read_only(self.coef_),
+            cov=_read_only(self.cov_),
+            cov_factor=cov_factor,
+            rdf=self.rdf,
+            resid_var=_read_only(self.resid_var_),
+            response_names=response_names,
+            fixed_effects=fixed_effects,
+        )
+
+    def partial_fit(self, X, y=None):
+        """Update a LinearModel with one more chunk of data.
+
+        Only running cross-product statistics of the chunk are kept, so a
+        model can be fit on far more rows than fit in memory. The first call
+        (or the first call after fit) starts a new stream. Variables are
+        interpreted, and Categorical levels / transformation parameters are
+        learned, from the first chunk; levels that only appear in later
+        chunks should be declared ahead of time.
+
+        Arguments:
+            X - A DataFrame containing all of the explanatory variables in the
+                model and possibly the response variable too.
+            y - An optional Series that contains the response variable.
+
+        Returns:
+            A DataFrame containing relevant statistics of the Model fitted on
+            every chunk seen so far.
+        """
+        if y is None:
+            data = X
+        else:
+            data = pd.concat([X, y], axis=1)
+        self._accumulate(data)
+        return self._finish_stream()
+
+    def fit_stream(self, chunks):
+        """Fit a LinearModel to an iterable of DataFrames without ever holding
+        all of the rows at once.
+
+        The resulting coefficients, covariance matrix, sums of squares and
+        likelihood match those of calling fit on the concatenated chunks.
+        See LinearModel.partial_fit for how levels are learned.
+
+        Arguments:
+            chunks - An iterable of DataFrames, each containing all of the
+                explanatory and response variables in the model.
+
+        Returns:
+            A DataFrame containing relevant statistics of fitted Model.
+        """
+        self._moments = None
+        for chunk in chunks:
+            self._accumulate(chunk)
+        if self._moments is None:
+            raise ValueError("Cannot fit a LinearModel on an empty stream.")
+        return self._finish_stream()
+
+    def _accumulate(self, data):
+        """Helper function that evaluates one chunk of data and merges it into
+        the running cross-product statistics."""
+        if self.multi_response:
+            raise NotImplementedError(
+                "Streaming fits are not supported for multiple responses."
+            )
+        if self.absorb is not None:
+            raise NotImplementedError(
+                "Streaming fits are not supported with absorbed factors."
+            )
+
+        if getattr(self, "_moments", None) is None:
+            self.categorical_levels = dict()
+            self.re = self.given_re.copy().interpret(data)
+            self.ex = self.given_ex.copy().interpret(data)
+            fit = True
+            self._moments = _Moments()
+            self._factor = None
+        else:
+            fit = False
+
+        X = self.ex.evaluate(data, fit=fit)
+        y = self.re.evaluate(data, fit=fit)
+        self._moments.update(np.hstack((X, y)))
+        self._design_columns = X.columns
+
+    def _finish_stream(self):
+        """Helper function that solves the least squares problem described by
+        the running cross-product statistics."""
+        moments = self._moments
+        self.n = moments.n
+        self.p = len(self._design_columns)
+
+        # Data is not kept around when streaming
+        self.slim()
+
+        if self.intercept:
+            S = moments.comoment
+            X_offsets = moments.mean[:-1]
+            y_offset = moments.mean[-1]
+        else:
+            S = moments.cross_product()
+            X_offsets = 0
+            y_offset = 0
+
+        S_xx, S_xy, S_yy = S[:-1, :-1], S[:-1, -1], S[-1, -1]
+        if self.p:
+            r = cholesky(S_xx, lower=False, check_finite=False)
+            z = solve_triangular(r, S_xy, trans="T", check_finite=False)
+            coef_ = solve_triangular(r, z, check_finite=False)
+        else:
+            r = np.empty(shape=(0, 0))
+            z = coef_ = np.empty(shape=0)
+        sse = max(S_yy - np.dot(z, z), 0)
+        sst = moments.comoment[-1, -1]
+
+        return self._finish_fit(
+            r, coef_, X_offsets, y_offset, sse, sst, self._design_columns,
+        )
+
+    def _fit_factor(self, factor, qr, lean=False):
+        """Helper function that fits the LinearModel from the _ColumnQR of
+        the columns of its terms in the _DesignFactor of a larger model
+        fit on the same data, without touching the data.
+
+        Arguments:
+            factor - A _DesignFactor holding every term of the model.
+            qr - The _ColumnQR of the terms of the model.
+            lean - Whether to defer the inference (see fit).
+
+        Returns:
+            A DataFrame containing relevant statistics of fitted Model, or
+            None if lean.
+        """
+        if not self.intercept or self.multi_response or self.sparse or \
+                self.absorb is not None:
+            raise NotImplementedError(
+                "Only dense, single response models with an intercept can be "
+                "fit from a design factor."
+            )
+        ex = self.given_ex.copy()
+        given = [
+            term for term in ex.get_terms() if not isinstance(term, Constant)
+        ]
+        if sorted(str(term) for term in given) != sorted(qr.terms):
+            raise ValueError(
+                "The terms of the model do not match the design factor."
+            )
+        # Use the fitted terms, in the order of the columns of the factor
+        terms = [factor.terms[name].copy() for name in qr.terms]
+        if isinstance(ex, Combination):
+            ex.terms = [
+                term for term in ex.terms if isinstance(term, Constant)
+            ] + terms
+        elif terms:
+            ex = terms[0]
+
+        self.categorical_levels = dict()
+        self.training_data = factor.data
+        self._moments = None
+        self._factor = None
+        self.X_train_ = None
+        self.y_train_ = None
+        self.fitted_ = None
+        self.residuals_ = None
+        self.re = factor.re
+        self.ex = ex
+        self.n = factor.n
+        self.p = len(qr.columns)
+
+        r, coef_, X_offsets, y_offset, sse, sst, cols = factor.solution(qr)
+        self._design_columns = cols
+        return self._finish_fit(
+            r, coef_, X_offsets, y_offset, sse, sst, cols, lean,
+        )
+
+    def add_rows(self, data):
+        """Update a fitted LinearModel with additional rows of data.
+
+        Instead of refitting, the triangular factor of the stored least
+        squares problem is updated, which only costs O(p^2) per row. The
+        coefficients, residual variance and covariance matrix are refreshed;
+        the per-row training data, fitted values and residuals are dropped
+        since they no longer describe the fitted rows. Categorical levels and
+        transformation parameters are kept from the original fit.
+
+        Arguments:
+            data - A DataFrame containing all of the explanatory and response
+                variables in the model for the new rows.
+
+        Returns:
+            A DataFrame containing relevant statistics of the updated Model.
+        """
+        R = self._get_factor()
+        self._factor = qr_append_rows(R, self._augmented_design(data))
+        return self._finish_factor()
+
+    def remove_rows(self, data):
+        """Update a fitted LinearModel by removing rows of data it was fit on.
+
+        This is the inverse of LinearModel.add_rows, and together they allow
+        refitting over a sliding window of data. The rows must have been
+        part of the data the model was fit on. A LinAlgError is raised if
+        the remaining rows would leave the design (nearly) rank deficient,
+        e.g. by removing every row of a level.
+
+        Arguments:
+            data - A DataFrame containing all of the explanatory and response
+                variables in the model for the rows to remove.
+
+        Returns:
+            A DataFrame containing relevant statistics of the updated Model.
+        """
+        R = self._get_factor()
+        self._factor = qr_delete_rows(R, self._augmented_design(data))
+        return self._finish_factor()
+
+    def _augmented_design(self, data):
+        """Helper function that evaluates [1, X, y] for already fitted
+        terms."""
+        X = self.ex.evaluate(data, fit=False)
+        y = self.re.evaluate(data, fit=False)
+        return np.hstack((np.ones((len(X), 1)), X, y))
+
+    def _get_factor(self):
+        """Helper function to get the triangular factor R of [1, X, y],
+        computing it from the fit if it has not been done yet."""
+        if self.ex is None:
+            raise AssertionError(
+                "The model must be fit prior to adding or removing rows."
+            )
+        if self.multi_response:
+            raise NotImplementedError(
+                "Row updates are not supported for multiple responses."
+            )
+        if self.absorb is not None:
+            raise NotImplementedError(
+                "Row updates are not supported with absorbed factors."
+            )
+
+        if getattr(self, "_factor", None) is None:
+            if getattr(self, "_moments", None) is not None:
+                # R.T @ R == Z.T @ Z can be assembled from the moments
+                moments = self._moments
+                root_n = np.sqrt(moments.n)
+                self._factor = np.block([
+                    [np.array([[root_n]]), root_n * moments.mean],
+                    [np.zeros((len(moments.mean), 1)),
+                     cholesky(moments.comoment, lower=False)],
+                ])
+            else:
+                Z = self._augmented_design(self.training_data)
+                self._factor = np.linalg.qr(Z, mode="r")
+        self._moments = None
+        return self._factor
+
+    def _finish_factor(self):
+        """Helper function that solves the least squares problem described by
+        the triangular factor R of [1, X, y].
+
+        Eliminating the column of ones first is the same as centering, so
+        the trailing block of R is the factor of the centered problem."""
+        R = self._factor
+        self.n = int(round(R[0, 0] ** 2))
+        self.p = R.shape[1] - 2
+
+        self.slim()
+
+        sst = (R[1:, -1] ** 2).sum()
+        if self.intercept:
+            X_offsets = R[0, 1:-1] / R[0, 0]
+            y_offset = R[0, -1] / R[0, 0]
+            R_xy = R[1:, 1:]
+        else:
+            X_offsets = 0
+            y_offset = 0
+            R_xy = np.linalg.qr(R[:, 1:], mode="r")
+
+        r, z = R_xy[:-1, :-1], R_xy[:-1, -1]
+        if self.p:
+            coef_ = solve_triangular(r, z, check_finite=False)
+        else:
+            coef_ = np.empty(shape=0)
+        sse = R_xy[-1, -1] ** 2
+
+        return self._finish_fit(
+            r, coef_, X_offsets, y_offset, sse, sst, self._design_columns,
+        )
+
     def likelihood(self, data=None):
         """Calculate likelihood for a fitted model on either original data or
         new data."""
@@ -293,7 +1982,8 @@ class LinearModel(Model):
         on either original data or new data."""
 
         if data is None:
-            residuals = self.residuals_
+            n = self.n
+            sse = self.get_sse()
         else:
             y = self.re.evaluate(data)
             y_hat = self.predict(
@@ -303,11 +1993,11 @@ class LinearModel(Model):
                 prediction_interval=False,
             )
             residuals = y[:, 0] - y_hat.iloc[:, 0]
-
-        n = len(residuals)
+            n = len(residuals)
+            sse = (residuals ** 2).sum()
 
         return (-n / 2 * (np.log(2 * np.pi) + np.log(self.resid_var_)) -
-                (1 / (2 * self.resid_var_)) * (residuals ** 2).sum())
+                (1 / (2 * self.resid_var_)) * sse)
 
     def confidence_intervals(self, alpha=None, conf=None):
         """Calculate confidence intervals for the coefficients.
@@ -334,13 +2024,17 @@ class LinearModel(Model):
 
         crit_prob = 1 - (alpha / 2)
 
-        lower_bound, upper_bound = _confint(self.coef_, self.se_coef_,
-                                            self.rdf, crit_prob)
+        coef, se_coef = self.coef_, self.se_coef_
+        if self.multi_response:
+            # Match the (response, term) layout of the fitted table
+            coef, se_coef = coef.T.stack(), se_coef.T.stack()
+
+        lower_bound, upper_bound = _confint(coef, se_coef, self.rdf, crit_prob)
 
         return pd.DataFrame({
             "%.1f%%" % (100 * (1 - crit_prob)): lower_bound,
             "%.1f%%" % (100 * crit_prob): upper_bound
-        }, index=self.coef_.index)
+        }, index=coef.index)
 
     def predict(
         self,
@@ -348,9 +2042,13 @@ class LinearModel(Model):
         for_plot=False,
         confidence_interval=False,
         prediction_interval=False,
+        n_threads=None,
     ):
         """Predict response values from a fitted Model.
 
+        Predictions only read the immutable snapshot of the fit (see
+        FittedState), so a model can be shared between threads.
+
         Arguments:
             data - A DataFrame containing the values of the explanatory
                 variables, for which predictions are desired.
@@ -362,19 +2060,95 @@ class LinearModel(Model):
             prediction_interval - If a prediction interval is desired, this is
                 a float between 0.0 and 1.0 indicating the confidence level to
                 use.
+            n_threads - An optional number of threads to split the rows
+                across. Default is None (the calling thread only).
 
         Returns:
             A DataFrame containing the predictions and/or intervals.
         """
+        state = getattr(self, "state_", None)
+        if state is None:
+            raise AssertionError("The model must be fit prior to predicting.")
+
+        if n_threads is None or n_threads <= 1 or len(data) <= 1:
+            return self._predict_state(
+                state,
+                data,
+                confidence_interval,
+                prediction_interval,
+            )
+
+        bounds = np.linspace(0, len(data), min(n_threads, len(data)) + 1)
+        bounds = bounds.astype(int)
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            chunks = executor.map(
+                lambda start, end: self._predict_state(
+                    state,
+                    data.iloc[start:end],
+                    confidence_interval,
+                    prediction_interval,
+                ),
+                bounds[:-1],
+                bounds[1:],
+            )
+            return pd.concat(list(chunks))
+
+    def _predict_state(
+        self,
+        state,
+        data,
+        confidence_interval,
+        prediction_interval,
+    ):
+        """Helper function that predicts from a snapshot of a fit."""
         # Construct the X matrix
-        X = self.ex.evaluate(data, fit=False)
-        if self.intercept:
-            n, _ = X.shape
-            X = np.hstack((X, np.ones((n, 1))))
-        y_vals = np.dot(X, self.coef_)
+        if state.sparse:
+            X = state.ex.evaluate_sparse(data, fit=False)
+            if state.intercept:
+                n, _ = X.shape
+                X = sparse.hstack((X, np.ones((n, 1))), format="csr")
+            y_vals = X @ state.coef
+            if confidence_interval or prediction_interval:
+                if state.cov is None:
+                    raise NotImplementedError(
+                        "Intervals need the covariance matrix, which is not "
+                        "stored for sparse fits with more than {} "
+                        "coefficients.".format(_SPARSE_COV_MAX)
+                    )
+                X = X.toarray()
+        else:
+            X = state.ex.evaluate(data, fit=False)
+            if state.intercept:
+                n, _ = X.shape
+                X = np.hstack((X, np.ones((n, 1))))
+            y_vals = np.dot(X, state.coef)
+
+        if state.fixed_effects is not None:
+            if confidence_interval or prediction_interval:
+                raise NotImplementedError(
+                    "Intervals are not supported with absorbed factors."
+                )
+            # Rows with levels not seen while fitting are predicted as NaN
+            for name, levels, effects in state.fixed_effects:
+                codes = levels.get_indexer(data[name])
+                effects = np.concatenate(
+                    (effects, np.full((1,) + effects.shape[1:], np.nan))
+                )
+                y_vals = y_vals + effects[codes]
+
+        if state.coef.ndim == 2:
+            if confidence_interval or prediction_interval:
+                raise NotImplementedError(
+                    "Intervals are not supported for multiple responses."
+                )
+            return pd.DataFrame(
+                y_vals,
+                columns=["Predicted " + name for name in state.response_names],
+                index=data.index,
+            )
 
         predictions = pd.DataFrame(
-            {"Predicted " + str(self.re): y_vals},
+            {"Predicted " + state.response_names[0]: y_vals},
             index=data.index
         )
 
@@ -384,12 +2158,14 @@ class LinearModel(Model):
                 widths = self._confidence_interval_width(
                     X,
                     confidence_interval,
+                    state,
                 )
             else:
                 alpha = prediction_interval
                 widths = self._prediction_interval_width(
                     X,
                     prediction_interval,
+                    state,
                 )
 
             crit_prob = 1 - (alpha / 2)
@@ -402,10 +2178,117 @@ class LinearModel(Model):
 
         return predictions
 
+    def compile(self):
+        """Compile a fitted model into a flat prediction plan.
+
+        The plan holds the column indices, Categorical level codes,
+        transformation parameters and coefficients it needs, so predictions
+        are computed with a few vectorized operations and without evaluating
+        the Expression tree. Intervals are not available from the plan.
+
+        Returns:
+            A CompiledModel object.
+        """
+        if self.ex is None:
+            raise AssertionError("The model must be fit prior to compiling.")
+        return CompiledModel(self)
+
+    def predict_one(self, record):
+        """Predict the response of a single record, e.g. for online scoring.
+
+        This uses the compiled prediction plan (see LinearModel.compile),
+        which is built on the first call and kept until the model is refit.
+
+        Arguments:
+            record - A dict mapping variable names to values, or a tuple of
+                the values in the order of the plan's names attribute.
+
+        Returns:
+            A float prediction, or a tuple of floats for multiple responses.
+        """
+        return self._compiled_plan().predict_one(record)
+
+    def predict_records(self, records):
+        """Predict the responses of a list of records.
+
+        See LinearModel.predict_one.
+
+        Arguments:
+            records - A list of dicts or tuples.
+
+        Returns:
+            An array of the predictions.
+        """
+        return self._compiled_plan().predict_records(records)
+
+    def predict_stream(
+        self,
+        chunks,
+        chunk_rows=None,
+        sink=None,
+        confidence_interval=False,
+        prediction_interval=False,
+    ):
+        """Predict response values chunk by chunk, so that memory use depends
+        on the size of a chunk rather than on the size of the data.
+
+        Arguments:
+            chunks - An iterable of DataFrames (e.g. from pandas.read_csv with
+                chunksize set), or a single DataFrame.
+            chunk_rows - An optional maximum number of rows to predict at a
+                time. Larger chunks are split.
+            sink - Where to send the predictions. If None (default), a
+                generator of DataFrames is returned. If a path ending in
+                '.csv', the predictions are appended to that CSV file. If a
+                path ending in '.npy', the predictions (and intervals) are
+                written as a 2D float array to that file.
+            confidence_interval - As in LinearModel.predict.
+            prediction_interval - As in LinearModel.predict.
+
+        Returns:
+            A generator of DataFrames if sink is None, the number of rows
+            written for a CSV sink, or a read-only memmap of the written array
+            for a .npy sink.
+        """
+        if isinstance(chunks, pd.DataFrame):
+            chunks = [chunks]
+
+        predictions = (
+            self.predict(
+                chunk,
+                confidence_interval=confidence_interval,
+                prediction_interval=prediction_interval,
+            )
+            for chunk in _split_chunks(chunks, chunk_rows)
+        )
+
+        if sink is None:
+            return predictions
+        if sink.endswith(".csv"):
+            rows = 0
+            for chunk in predictions:
+                chunk.to_csv(sink, mode="a" if rows else "w", header=not rows)
+                rows += len(chunk)
+            return rows
+        if sink.endswith(".npy"):
+            return _write_npy(sink, (chunk.values for chunk in predictions))
+        raise ValueError(
+            "Unsupported sink {}, expected a path ending in .csv or "
+            ".npy.".format(sink)
+        )
+
+    def _compiled_plan(self):
+        """Helper function to get the compiled plan of the current fit."""
+        cached = getattr(self, "_compiled", None)
+        if cached is None or cached[0] is not self.ex or \
+                cached[1] is not self.coef_:
+            cached = (self.ex, self.coef_, self.compile())
+            self._compiled = cached
+        return cached[2]
+
     def get_sse(self):
         """Get the SSE of a fitted model."""
-        sse = ((self.y_train_ - self.fitted_) ** 2).sum()
-        return sse
+        return self._sse
 
     def get_ssr(self):
         """Get the SSR of a fitted model."""
@@ -414,8 +2297,7 @@ class LinearModel(Model):
 
     def get_sst(self):
         """Get the SST of a fitted model."""
-        sst = ((self.y_train_ - self.y_train_.mean()) ** 2).sum()
-        return sst
+        return self._sst
 
     def r_squared(self, X=None, y=None, adjusted=False, **kwargs):
         """Calculate the (adjusted) R^2 value of the model.
@@ -459,22 +2341,26 @@ class LinearModel(Model):
         """
         return self.r_squared(X, y, adjusted, **kwargs)
 
-    def _prediction_interval_width(self, X_new, alpha=0.05):
+    def _prediction_interval_width(self, X_new, alpha=0.05, state=None):
         """Helper function for calculating prediction interval widths."""
-        mse = self.get_sse() / self.rdf
-        s_yhat_squared = (X_new.dot(self.cov_) * X_new).sum(axis=1)
+        if state is None:
+            state = self.state_
+        mse = state.resid_var
+        s_yhat_squared = _row_quad_forms(X_new, state.cov_factor)
         s_pred_squared = mse + s_yhat_squared
 
-        t_crit = stats.t.ppf(1 - (alpha / 2), self.rdf)
+        t_crit = _t_critical(1 - (alpha / 2), state.rdf)
 
         return t_crit * (s_pred_squared ** 0.5)
 
-    def _confidence_interval_width(self, X_new, alpha=0.05):
+    def _confidence_interval_width(self, X_new, alpha=0.05, state=None):
         """Helper function for calculating confidence interval widths."""
+        if state is None:
+            state = self.state_
         _, p = X_new.shape
-        s_yhat_squared = (X_new.dot(self.cov_) * X_new).sum(axis=1)
+        s_yhat_squared = _row_quad_forms(X_new, state.cov_factor)
         # t_crit = stats.t.ppf(1 - (alpha / 2), n-p)
-        W_crit_squared = p * stats.f.ppf(1 - (alpha / 2), p, self.rdf)
+        W_crit_squared = p * _f_critical(1 - (alpha / 2), p, state.rdf)
         return (W_crit_squared ** 0.5) * (s_yhat_squared ** 0.5)
 
     def plot(
@@ -513,6 +2399,11 @@ class LinearModel(Model):
         Returns:
             A matplotlib plot appropriate visualization of the model.
         """
+        if self.multi_response:
+            raise NotImplementedError(
+                "Plotting is not supported for multiple responses."
+            )
+
         if confidence_band and prediction_band:
             raise Exception(
                 "Only one of {confidence_band, prediction_band} may "
@@ -1027,8 +2918,10 @@ class LinearModel(Model):
             yaxis = LinearModel(sans_xi, self.re)
             xaxis = LinearModel(sans_xi, xi)
 
-            yaxis.fit(self.training_data)
-            xaxis.fit(self.training_data)
+            # Every pair of fits shares most terms on the same data
+            with term_cache.enabled():
+                yaxis.fit(self.training_data)
+                xaxis.fit(self.training_data)
 
             ax.scatter(xaxis.residuals_, yaxis.residuals_, alpha=alpha)
             ax.set_title("Leverage Plot for " + str(xi))
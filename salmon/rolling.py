@@ -0,0 +1,90 @@
+"""Contains the logic for fitting a model over rolling and expanding windows
+of data."""
+
+import numpy as np
+import pandas as pd
+
+from .model import qr_append_rows, qr_delete_rows, _factor_estimates
+
+
+def rolling_fit(model, data, window, step=1, expanding=False):
+    """Fit a model on every window of rows in a DataFrame.
+
+    The design matrix is evaluated once and the windows are walked by
+    updating a single QR factorization with the rows entering and leaving
+    the window, so each step costs O(step * p^2) rather than a full fit.
+    The factorization is recomputed from scratch once a window's worth of
+    rows have been deleted to keep rounding errors from accumulating, or
+    when a window is rank deficient (its estimates are then NaN).
+    Categorical levels and transformation parameters are learned on all of
+    the data.
+
+    Arguments:
+        model - A LinearModel object whose explanatory and response
+            Expressions define the model to fit. It is not modified.
+        data - A DataFrame, ordered as the windows should be taken.
+        window - An integer number of rows in each window. For expanding
+            windows this is the size of the first window.
+        step - An integer number of rows between the ends of consecutive
+            windows. Default is 1.
+        expanding - If True, every window starts at the first row. If
+            False, windows are of a fixed size. Default is False.
+
+    Returns:
+        A dictionary with DataFrames 'coef' and 'se' of the coefficients and
+        their standard errors, and a Series 'resid_var' of the residual
+        variances. All are indexed by the label of the last row of each
+        window.
+    """
+    if window < 1 or step < 1:
+        raise ValueError("Both window and step must be positive integers.")
+
+    re = model.given_re.copy().interpret(data)
+    ex = model.given_ex.copy().interpret(data)
+    X = ex.evaluate(data)
+    y = re.evaluate(data)
+    Z = np.hstack((np.ones((len(X), 1)), X, y))
+
+    columns = list(X.columns)
+    if model.intercept:
+        columns.append("Intercept")
+
+    n = len(Z)
+    ends = list(range(window, n + 1, step))
+    coefs = np.empty((len(ends), len(columns)))
+    ses = np.empty((len(ends), len(columns)))
+    resid_vars = np.empty(len(ends))
+
+    R = None
+    start = end = 0
+    deleted_rows = 0
+    for i, new_end in enumerate(ends):
+        new_start = 0 if expanding else new_end - window
+        deleted_rows += new_start - start
+
+        refactor = R is None or new_start >= end or deleted_rows >= window
+        if not refactor:
+            R = qr_append_rows(R, Z[end:new_end])
+            try:
+                R = qr_delete_rows(R, Z[start:new_start])
+            except np.linalg.LinAlgError:
+                # The window lost every row of a column (e.g. of a level),
+                # so it is factored from scratch and gets NaN estimates
+                refactor = True
+        if refactor:
+            R = np.linalg.qr(Z[new_start:new_end], mode="r")
+            deleted_rows = 0
+
+        start, end = new_start, new_end
+        coefs[i], ses[i], resid_vars[i] = _factor_estimates(
+            R,
+            end - start,
+            model.intercept,
+        )
+
+    index = data.index[[end - 1 for end in ends]]
+    return dict(
+        coef=pd.DataFrame(coefs, index=index, columns=columns),
+        se=pd.DataFrame(ses, index=index, columns=columns),
+        resid_var=pd.Series(resid_vars, index=index),
+    )
@@ -1,7 +1,17 @@
+import itertools
+import os
+import tempfile
+import tracemalloc
 import unittest
 from .expression import *
 from .model import *
+from .comparison import *
+from .building import *
+from .rolling import *
+from .grouped import *
 import pandas as pd
+import scipy.stats as stats
+import matplotlib.pyplot as plt
 
 def floatComparison(a, b, eps = 0.0001):
     if isinstance(a, (pd.Series, pd.DataFrame)) or isinstance(b, (pd.Series, pd.DataFrame)):
@@ -130,6 +140,15 @@ class TestCategoricalMethods(unittest.TestCase):
     def test_interpret(self):
         var = Categorical("A")
         self.assertEqual(var.interpret(None), var)
+
+    def test_evaluate_sparse(self):
+        data = pd.DataFrame({"A" : ["a", "b", "c", "b"], "B" : [1., 2., 0., 4.]})
+        ex = C("A") * Q("B") + C("A")
+        dense = ex.evaluate(data)
+        sparse = ex.evaluate_sparse(data, fit=False)
+        self.assertEqual(list(dense.columns), sparse.columns)
+        self.assertTrue(np.allclose(dense, sparse.toarray()))
+        self.assertEqual(sparse.nnz, 5)
                 
 class TestInteractionMethods(unittest.TestCase):
     
@@ -214,7 +233,83 @@ class TestCombinationMethods(unittest.TestCase):
                 self.assertTrue(isinstance(v, Categorical))
             else:
                 self.assertTrue(isinstance(v, Quantitative))
+
+    def test_evaluate_buffer(self):
+        comb = C("species") * Q("petal_width") + Log(Q("sepal_width"))
+        comb.interpret(iris)
+        X = comb.evaluate(iris)
+        self.assertTrue(X.flags.f_contiguous)
+        expected = np.hstack([term.evaluate(iris) for term in comb.terms])
+        self.assertTrue(np.allclose(X, expected))
+        X32 = comb.evaluate(iris, dtype=np.float32)
+        self.assertEqual(X32.dtype, np.float32)
+        self.assertEqual(list(X32.columns), list(X.columns))
         
+class TestTermCache(unittest.TestCase):
+
+    def setUp(self):
+        from . import expression
+        self.cache = expression.term_cache
+        self.cache.clear()
+
+    def test_refit_hits_cache(self):
+        with self.cache.enabled():
+            data = pd.DataFrame({"A" : [1., 2., 3., 4., 5., 6.], "B" : ["x", "y", "x", "z", "y", "z"],
+                                 "Y" : [1., 3., 2., 5., 4., 4.]})
+            explanatory = Q("A") ** 2 + C("B")
+            first = LinearModel(explanatory, Q("Y"))
+            first.fit(data)
+            hits = self.cache.hits
+            second = LinearModel(explanatory, Q("Y"))
+            second.fit(data)
+            self.assertEqual(self.cache.hits, hits + 2)
+            # Levels learned on the cache hit are still available for predicting
+            newData = pd.DataFrame({"A" : [1., 2.], "B" : ["z", "y"]})
+            self.assertTrue(np.allclose(first.predict(newData), second.predict(newData)))
+
+    def test_changed_data_misses_cache(self):
+        with self.cache.enabled():
+            data = pd.DataFrame({"A" : [1., 2., 3., 4.], "Y" : [1., 3., 2., 5.]})
+            model = LinearModel(Q("A") ** 2, Q("Y"))
+            model.fit(data)
+            misses = self.cache.misses
+            data["A"] = [2., 2., 3., 4.]
+            model.fit(data)
+            self.assertEqual(self.cache.misses, misses + 1)
+            self.assertTrue(np.allclose(model.predict(data).iloc[:, 0], model.fitted_))
+
+    def test_eviction(self):
+        with self.cache.enabled():
+            self.cache.resize(8 * 4)
+            try:
+                data = pd.DataFrame({"A" : [1., 2., 3., 4.]})
+                for power in range(2, 5):
+                    Combination([Q("A") ** power]).copy().interpret(data).evaluate(data)
+                self.assertEqual(len(self.cache), 1)
+                self.assertLessEqual(self.cache.nbytes, 8 * 4)
+            finally:
+                self.cache.resize(64 * 2 ** 20)
+
+    def test_disabled_by_default(self):
+        data = pd.DataFrame({"A" : [1., 2., 3., 4.], "Y" : [1., 3., 2., 5.]})
+        model = LinearModel(Q("A") ** 2, Q("Y"))
+        self.assertFalse(self.cache.active)
+        model.fit(data)
+        model.predict(data)
+        self.assertEqual(len(self.cache), 0)
+        with self.cache.enabled():
+            self.assertTrue(self.cache.active)
+            model.fit(data)
+        self.assertEqual(len(self.cache), 1)
+        self.assertFalse(self.cache.active)
+
+    def test_enabled_per_thread(self):
+        from concurrent.futures import ThreadPoolExecutor
+        with self.cache.enabled():
+            with ThreadPoolExecutor(1) as executor:
+                self.assertFalse(executor.submit(lambda: self.cache.active).result())
+            self.assertTrue(self.cache.active)
+
 iris = pd.read_csv("https://raw.githubusercontent.com/uiuc-cse/data-fa14/gh-pages/data/iris.csv")
 
 
@@ -269,7 +364,364 @@ class TestModelMethods(unittest.TestCase):
         self.assertEqual(len(ones), 150)
         self.assertTrue(all(ones["Intercept"] == 1))
         
-    '''        
+    def test_fit_stream(self):
+        levels = ["virginica", "setosa", "versicolor"]
+        explanatory = Q("petal_width") + C("species", levels=levels)
+        response = Q("sepal_width")
+        model = LinearModel(explanatory, response)
+        expected = model.fit(iris)
+        expected_sse, expected_ll = model.get_sse(), model.log_likelihood()
+
+        stream_model = LinearModel(explanatory, response)
+        chunks = (iris.iloc[i:i + 40] for i in range(0, len(iris), 40))
+        results = stream_model.fit_stream(chunks)
+        self.assertTrue(np.allclose(results.values, expected.values))
+        self.assertTrue(np.allclose(stream_model.cov_, model.cov_))
+        self.assertTrue(floatComparison(expected_sse, stream_model.get_sse()))
+        self.assertTrue(floatComparison(expected_ll, stream_model.log_likelihood()))
+
+    def test_partial_fit(self):
+        model = LinearModel(Q("petal_width"), Q("sepal_width"), intercept=False)
+        expected = model.fit(iris)
+        for i in range(0, len(iris), 50):
+            results = model.partial_fit(iris.iloc[i:i + 50])
+        self.assertTrue(np.allclose(results.values, expected.values))
+
+    def test_add_remove_rows(self):
+        levels = ["virginica", "setosa", "versicolor"]
+        explanatory = Q("petal_width") + C("species", levels=levels)
+        response = Q("sepal_width")
+        shuffled = iris.sample(frac=1, random_state=0)
+
+        model = LinearModel(explanatory, response)
+        expected = model.fit(shuffled)
+
+        window_model = LinearModel(explanatory, response)
+        window_model.fit(shuffled.iloc[:100])
+        results = window_model.add_rows(shuffled.iloc[100:])
+        self.assertTrue(np.allclose(results.values, expected.values))
+        self.assertTrue(np.allclose(window_model.cov_, model.cov_))
+
+        expected = model.fit(shuffled.iloc[30:])
+        results = window_model.remove_rows(shuffled.iloc[:30])
+        self.assertTrue(np.allclose(results.values, expected.values))
+        self.assertTrue(floatComparison(model.get_sse(), window_model.get_sse()))
+        self.assertTrue(floatComparison(model.get_sst(), window_model.get_sst()))
+
+    def test_multi_response(self):
+        explanatory = Q("petal_width") + C("species")
+        responses = [Q("sepal_width"), Q("sepal_length"), Log(Q("petal_length"))]
+        model = LinearModel(explanatory, responses)
+        results = model.fit(iris)
+        self.assertEqual(len(results), 3 * 4)
+
+        predictions = model.predict(iris)
+        self.assertEqual(predictions.shape, (150, 3))
+        for i, response in enumerate(responses):
+            single = LinearModel(explanatory, response)
+            expected = single.fit(iris)
+            name = str(model.re[i])
+            self.assertTrue(np.allclose(results.loc[name].values, expected.values))
+            self.assertTrue(np.allclose(model.cov_[i], single.cov_))
+            self.assertTrue(np.allclose(predictions.iloc[:, i], single.predict(iris).iloc[:, 0]))
+
+    def test_multi_output_combination(self):
+        model = LinearModel(Q("petal_width"), Q("sepal_width") + Q("sepal_length"), multi_output=True)
+        model.fit(iris)
+        self.assertEqual(list(model.coef_.columns), ["sepal_length", "sepal_width"])
+        self.assertEqual(model.confidence_intervals().shape, (4, 2))
+
+    def test_absorb(self):
+        full = LinearModel(Q("petal_width") + Q("petal_length") + C("species"), Q("sepal_length"))
+        full_table = full.fit(iris)
+        model = LinearModel(Q("petal_width") + Q("petal_length"), Q("sepal_length"), absorb=C("species"))
+        table = model.fit(iris)
+        self.assertEqual(model.rdf, full.rdf)
+        self.assertTrue(np.allclose(table, full_table.loc[table.index]))
+        self.assertTrue(np.allclose(model.predict(iris).iloc[:, 0], full.fitted_))
+
+    def test_absorb_nested_factors(self):
+        # plot is nested in block, which is nested in species, so the levels
+        # of plot span those of the other two
+        block = iris.species + (iris.petal_width > iris.petal_width.median()).astype(str)
+        data = iris.assign(
+            block=block,
+            plot=block + (iris.sepal_width > iris.sepal_width.median()).astype(str),
+        )
+        model = LinearModel(Q("petal_width") + Q("petal_length"), Q("sepal_length"),
+                            absorb=C("species") + C("block") + C("plot"))
+        model.fit(data)
+        dummies = pd.get_dummies(data[["species", "block", "plot"]]).values.astype(float)
+        rank = np.linalg.matrix_rank(dummies)
+        self.assertEqual(model.absorbed_df_, rank)
+        self.assertEqual(model.rdf, len(data) - 2 - rank)
+        X = np.hstack((data[["petal_width", "petal_length"]].values, dummies))
+        coef = np.linalg.lstsq(X, data.sepal_length.values, rcond=None)[0]
+        self.assertTrue(np.allclose(model.coef_.loc[["petal_width", "petal_length"]], coef[:2]))
+
+    def test_compile(self):
+        ex = C("species") * Q("petal_width") + Log(Q("sepal_width")) + Center(Q("petal_length"))
+        model = LinearModel(ex, Q("sepal_length"))
+        model.fit(iris)
+        compiled = model.compile()
+        self.assertTrue(np.allclose(compiled.predict(iris), model.predict(iris).iloc[:, 0]))
+        self.assertEqual(list(compiled.predict_frame(iris).columns), list(model.predict(iris).columns))
+        with self.assertRaises(ValueError):
+            compiled.predict(pd.DataFrame({"species": ["unknown"], "petal_width": [1.], "sepal_width": [1.], "petal_length": [1.]}))
+
+    def test_predict_one(self):
+        model = LinearModel(C("species") * Q("petal_width") + Log(Q("sepal_width")), Q("sepal_length"))
+        model.fit(iris)
+        records = iris.to_dict("records")
+        predictions = model.predict(iris).iloc[:, 0]
+        self.assertTrue(np.isclose(model.predict_one(records[0]), predictions.iloc[0]))
+        self.assertTrue(np.allclose(model.predict_records(records), predictions))
+        self.assertTrue(np.allclose(model.predict_records(records[:3]), predictions.iloc[:3]))
+
+    def test_predict_stream(self):
+        model = LinearModel(C("species") * Q("petal_width"), Q("sepal_length"))
+        model.fit(iris)
+        full = model.predict(iris, prediction_interval=0.05)
+        chunks = list(model.predict_stream(iris, chunk_rows=40, prediction_interval=0.05))
+        self.assertEqual([len(chunk) for chunk in chunks], [40, 40, 40, 30])
+        self.assertTrue(np.allclose(pd.concat(chunks), full))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "predictions.npy")
+            written = model.predict_stream([iris[:70], iris[70:]], chunk_rows=32, sink=path, prediction_interval=0.05)
+            self.assertTrue(np.allclose(written, full))
+            del written
+
+    def test_predict_threads(self):
+        model = LinearModel(C("species") * Q("petal_width") + Center(Q("petal_length")), Q("sepal_length"))
+        model.fit(iris)
+        state = model.state_
+        self.assertFalse(state.coef.flags.writeable)
+        self.assertTrue(isinstance(state.ex.terms, tuple))
+        full = model.predict(iris, confidence_interval=0.05)
+        threaded = model.predict(iris, confidence_interval=0.05, n_threads=3)
+        self.assertTrue(threaded.index.equals(full.index))
+        self.assertTrue(np.allclose(threaded, full))
+        model.fit(iris[::2])
+        self.assertFalse(model.state_ is state)
+        self.assertTrue(np.allclose(model._predict_state(state, iris, 0.05, False), full))
+
+    def test_interval_widths(self):
+        model = LinearModel(C("species") * Q("petal_width"), Q("sepal_length"))
+        model.fit(iris)
+        X = np.hstack((model.ex.evaluate(iris, fit=False), np.ones((len(iris), 1))))
+        quad = (X.dot(model.cov_) * X).sum(axis=1)
+        t_crit = stats.t.ppf(0.975, model.rdf)
+        expected = t_crit * np.sqrt(model.resid_var_ + quad)
+        self.assertTrue(np.allclose(model._prediction_interval_width(X, 0.05), expected))
+
+    def test_solver(self):
+        ex = C("species") * Q("petal_width") + Q("sepal_width")
+        qr_table = LinearModel(ex, Q("sepal_length"), solver="qr").fit(iris)
+        model = LinearModel(ex, Q("sepal_length"), solver="cholesky")
+        table = model.fit(iris)
+        self.assertEqual(model.solver_, "cholesky")
+        self.assertTrue(np.allclose(table, qr_table.loc[table.index]))
+        # The Gram matrix is accumulated over blocks of centered rows
+        from . import model as model_module
+        block_bytes = model_module._CHOLESKY_BLOCK_BYTES
+        model_module._CHOLESKY_BLOCK_BYTES = 8 * 8 * 7
+        try:
+            blocked = LinearModel(ex, Q("sepal_length"), solver="cholesky").fit(iris)
+        finally:
+            model_module._CHOLESKY_BLOCK_BYTES = block_bytes
+        self.assertTrue(np.allclose(blocked, table))
+        data = iris.assign(nearly_sepal_width=iris["sepal_width"] + 1e-9 * np.arange(len(iris)))
+        model = LinearModel(Q("sepal_width") + Q("nearly_sepal_width"), Q("sepal_length"), solver="cholesky")
+        model.fit(data)
+        self.assertEqual(model.solver_, "qr")
+        with self.assertRaises(ValueError):
+            LinearModel(Q("sepal_width"), Q("sepal_length"), solver="svd")
+        # Every solver agrees on an intercept-only model
+        qr_table = LinearModel(Constant(1), Q("sepal_length"), solver="qr").fit(iris)
+        for solver in ("cholesky", "tsqr", "sketch", "auto"):
+            table = LinearModel(Constant(1), Q("sepal_length"), solver=solver).fit(iris)
+            self.assertTrue(np.allclose(table, qr_table))
+
+    def test_lean_fit(self):
+        ex = C("species") * Q("petal_width") + Q("sepal_width")
+        full = LinearModel(ex, Q("sepal_length"))
+        table = full.fit(iris)
+        lean = LinearModel(ex, Q("sepal_length"))
+        self.assertIsNone(lean.fit(iris, lean=True))
+        self.assertIsNotNone(lean._pending_inference)
+        self.assertTrue(np.allclose(lean.coef_, table["Coefficient"]))
+        self.assertEqual(lean.rank_, len(table))
+        self.assertTrue(np.allclose(lean.p_, table["p"]))
+        self.assertIsNone(lean._pending_inference)
+        self.assertTrue(np.allclose(lean.table_, table))
+        self.assertTrue(np.allclose(lean.cov_, full.cov_))
+
+    def test_lean_fit_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+        ex = C("species") * Q("petal_width") + Q("sepal_width")
+        expected = LinearModel(ex, Q("sepal_length")).fit(iris)
+        for _ in range(20):
+            lean = LinearModel(ex, Q("sepal_length"))
+            lean.fit(iris, lean=True)
+            with ThreadPoolExecutor(4) as executor:
+                # Every thread may be the first to look at the inference
+                results = list(executor.map(lambda _: lean.predict(iris), range(4)))
+            for result in results:
+                self.assertTrue(np.allclose(result, results[0]))
+            self.assertTrue(np.allclose(lean.table_, expected))
+
+    def test_float32(self):
+        ex = C("species") * Q("petal_width") + Q("sepal_width")
+        model64 = LinearModel(ex, Q("sepal_length"))
+        table64 = model64.fit(iris)
+        model32 = LinearModel(ex, Q("sepal_length"), dtype=np.float32)
+        table32 = model32.fit(iris)
+        self.assertEqual(model32.X_train_.dtype, np.float32)
+        self.assertEqual(model32.residuals_.dtype, np.float32)
+        self.assertEqual(model32.X_train_.nbytes * 2, model64.X_train_.nbytes)
+        # The documented bound: a relative 6e-8 times the condition number
+        cond = np.linalg.cond(model64.X_train_ - model64.X_train_.mean(axis=0))
+        error = np.abs(table32["Coefficient"] - table64["Coefficient"])
+        self.assertTrue((error <= 10 * 6e-8 * cond * np.abs(table64["Coefficient"]).max()).all())
+        self.assertTrue(np.allclose(table32, table64.loc[table32.index], rtol=1e-4))
+        with self.assertRaises(ValueError):
+            LinearModel(ex, Q("sepal_length"), dtype=np.int64)
+
+    def test_float32_absorb(self):
+        ex = Q("petal_width") + Q("sepal_width")
+        model64 = LinearModel(ex, Q("sepal_length"), absorb=C("species"))
+        table64 = model64.fit(iris)
+        model32 = LinearModel(ex, Q("sepal_length"), absorb=C("species"), dtype=np.float32)
+        table32 = model32.fit(iris)
+        self.assertEqual(model32.residuals_.dtype, np.float32)
+        self.assertEqual(model32.fitted_.dtype, np.float32)
+        self.assertTrue(np.allclose(model32.residuals_, model64.residuals_, atol=1e-5))
+        self.assertTrue(np.allclose(table32, table64, rtol=1e-4))
+
+    def test_slim(self):
+        ex = C("species") + Q("petal_width") + Q("sepal_width")
+        full = LinearModel(ex, Q("sepal_length"))
+        full.fit(iris)
+        reduced = LinearModel(Q("petal_width") + Q("sepal_width"), Q("sepal_length"))
+        reduced.fit(iris)
+        expected = full.predict(iris, confidence_interval=True)
+        anova_table = anova(full, reduced)
+        slim = LinearModel(ex, Q("sepal_length"))
+        slim.fit(iris, keep_data=False)
+        reduced.slim()
+        self.assertIsNone(slim.training_data)
+        self.assertIsNone(slim.residuals_)
+        self.assertTrue(np.allclose(slim.predict(iris, confidence_interval=True), expected))
+        self.assertTrue(np.allclose(slim.confidence_intervals(), full.confidence_intervals()))
+        self.assertTrue(np.isclose(slim.log_likelihood(), full.log_likelihood()))
+        self.assertEqual(anova(slim, reduced).to_string(), anova_table.to_string())
+        with self.assertRaises(Exception):
+            anova(slim)
+
+    def test_design_not_centered(self):
+        model = LinearModel(Q("petal_width") + Q("sepal_width"), Q("sepal_length"))
+        model.fit(iris)
+        self.assertTrue(np.allclose(model.X_train_.get_column("petal_width"), iris["petal_width"]))
+        self.assertTrue(np.allclose(model.fitted_ + model.residuals_, iris["sepal_length"]))
+
+    def test_tsqr(self):
+        ex = C("species") * Q("petal_width") + Q("sepal_width")
+        qr_table = LinearModel(ex, Q("sepal_length"), solver="qr").fit(iris)
+        model = LinearModel(ex, Q("sepal_length"), solver="tsqr", n_jobs=2)
+        table = model.fit(iris)
+        self.assertEqual(model.solver_, "tsqr")
+        self.assertTrue(np.allclose(table, qr_table.loc[table.index]))
+        # An intercept-only model has no columns to factor
+        table = LinearModel(Constant(1), Q("sepal_length"), solver="tsqr").fit(iris)
+        qr_table = LinearModel(Constant(1), Q("sepal_length"), solver="qr").fit(iris)
+        self.assertTrue(np.allclose(table, qr_table))
+        self.assertTrue(np.isclose(table.loc["Intercept", "Coefficient"], iris["sepal_length"].mean()))
+
+    def test_sketch(self):
+        ex = C("species") * Q("petal_width") + Q("sepal_width")
+        qr_table = LinearModel(ex, Q("sepal_length"), solver="qr").fit(iris)
+        model = LinearModel(ex, Q("sepal_length"), solver="sketch", random_state=1)
+        table = model.fit(iris)
+        self.assertTrue(np.allclose(table, qr_table.loc[table.index]))
+        self.assertTrue(np.isclose(model.solver_info_["residual_norm"], np.sqrt(model.get_sse())))
+        self.assertGreaterEqual(model.solver_info_["iterations"], 0)
+        # An intercept-only model has no columns to sketch
+        model = LinearModel(Constant(1), Q("sepal_length"), solver="sketch")
+        table = model.fit(iris)
+        qr_table = LinearModel(Constant(1), Q("sepal_length"), solver="qr").fit(iris)
+        self.assertTrue(np.allclose(table, qr_table))
+        self.assertTrue(np.isclose(model.solver_info_["residual_norm"], np.sqrt(model.get_sse())))
+
+    def test_sparse_fit(self):
+        ex = C("species") * Q("petal_width") + Q("petal_length")
+        dense = LinearModel(ex, Q("sepal_length"))
+        dense_table = dense.fit(iris)
+        model = LinearModel(ex, Q("sepal_length"), sparse=True)
+        table = model.fit(iris)
+        self.assertTrue(np.allclose(table.loc[dense_table.index], dense_table))
+        self.assertTrue(np.allclose(model.cov_, dense.cov_))
+        self.assertTrue(np.allclose(
+            model.predict(iris, confidence_interval=0.05),
+            dense.predict(iris, confidence_interval=0.05),
+        ))
+
+    def test_sparse_fit_many_levels(self):
+        rng = np.random.RandomState(0)
+        levels = 3000
+        data = pd.DataFrame({"g" : rng.randint(0, levels, 4 * levels).astype(str),
+                             "x" : rng.randn(4 * levels)})
+        data["y"] = 2 * data.x + data.g.astype(int) / levels + rng.randn(len(data))
+        model = LinearModel(C("g") + Q("x"), Q("y"), sparse=True)
+        tracemalloc.start()
+        try:
+            table = model.fit(data)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        # Nothing the size of a dense levels x levels matrix is formed
+        self.assertLess(peak, levels ** 2 * 4)
+        self.assertIsNone(model.cov_)
+        self.assertEqual(len(table), data.g.nunique() + 1)
+        # The slope of x is that of the within-level regression
+        x_within = data.x - data.groupby("g").x.transform("mean")
+        y_within = data.y - data.groupby("g").y.transform("mean")
+        slope = (x_within * y_within).sum() / (x_within ** 2).sum()
+        self.assertTrue(np.isclose(table.loc["x", "Coefficient"], slope))
+        se = np.sqrt(model.resid_var_ / (x_within ** 2).sum())
+        self.assertTrue(np.isclose(table.loc["x", "SE"], se))
+        # The intercept is the mean of the baseline level net of the slope
+        baseline = data[~data.g.isin([column[2:-1] for column in table.index[:-1]])]
+        intercept = baseline.y.mean() - slope * baseline.x.mean()
+        self.assertTrue(np.isclose(table.loc["Intercept", "Coefficient"], intercept))
+
+    def test_sparse_fit_singular(self):
+        data = iris.assign(kind=iris.species.map(lambda name: "k_" + name),
+                           double_width=2 * iris.petal_width,
+                           mean_width=iris.groupby("species").petal_width.transform("mean"))
+        # Collinear sparse columns, collinear dense columns and a dense column
+        # in the span of the sparse ones
+        for ex in (C("species") + C("kind"),
+                   C("species") + Q("petal_width") + Q("double_width"),
+                   C("species") + Q("mean_width")):
+            model = LinearModel(ex, Q("sepal_length"), sparse=True)
+            with self.assertRaises(np.linalg.LinAlgError):
+                model.fit(data)
+
+    def test_sparse_fit_options(self):
+        ex = C("species") * Q("petal_width") + Q("petal_length")
+        for kwargs in ({"solver" : "qr"}, {"dtype" : np.float32}):
+            with self.assertRaises(NotImplementedError):
+                LinearModel(ex, Q("sepal_length"), sparse=True, **kwargs)
+        table = LinearModel(ex, Q("sepal_length"), sparse=True).fit(iris)
+        lean = LinearModel(ex, Q("sepal_length"), sparse=True)
+        self.assertIsNone(lean.fit(iris, lean=True))
+        self.assertIsNotNone(lean._pending_inference)
+        self.assertTrue(np.allclose(lean.coef_, table["Coefficient"]))
+        self.assertTrue(np.allclose(lean.table_, table))
+        self.assertIsNone(lean._pending_inference)
+        self.assertEqual(lean.rank_, len(table))
+
+    '''
     def test_extract_columns(self):
         self.assertEqual()
         with self.assertRaises(Exception):
@@ -289,6 +741,189 @@ class TestModelMethods(unittest.TestCase):
             pass            
     '''
     
+class TestBuildingMethods(unittest.TestCase):
+
+    def test_stepwise(self):
+        ex = C("species") + Q("petal_width") + Q("petal_length") + Q("sepal_width")
+        full = LinearModel(ex, Q("sepal_length"))
+        full.fit(iris)
+        for forward in (False, True):
+            result = stepwise(full, "bic", forward=forward)
+            best = result["best_model"]
+            by_hand = LinearModel(best.given_ex, Q("sepal_length"))
+            table = by_hand.fit(iris)
+            self.assertTrue(np.allclose(best.table_, table.loc[best.table_.index]))
+            self.assertTrue(np.isclose(result["metric"]._score, BIC(best)._score))
+            # The chosen model is fully fit, as if by hand
+            self.assertTrue(np.allclose(best.residuals_, by_hand.residuals_))
+            self.assertTrue(np.isclose(best.r_squared(), by_hand.r_squared()))
+            best.residual_plots()
+            plt.close("all")
+        self.assertEqual(len(full.ex.get_terms()), 4)
+
+    def test_stepwise_poly(self):
+        full = LinearModel(Poly("petal_width", 2) + Q("sepal_width") + C("species"), Q("sepal_length"))
+        full.fit(iris)
+        for metric, func in (("aic", AIC), ("bic", BIC)):
+            result = stepwise(full, metric)
+            best = result["best_model"]
+            self.assertNotIn("0*", str(best))
+            by_hand = LinearModel(best.given_ex, Q("sepal_length"))
+            by_hand.fit(iris)
+            self.assertTrue(np.isclose(result["metric"]._score, func(by_hand)._score))
+        self.assertEqual(str(best), "sepal_length ~ 1+petal_width+petal_width^2+sepal_width")
+
+    def test_scores(self):
+        model = LinearModel(C("species") + Q("petal_width"), Q("sepal_length"))
+        model.fit(iris)
+        n, p = model.n, model.p
+        self.assertEqual(model.summary_.rank, p + 1)
+        self.assertTrue(np.isclose(AIC(model)._score, 2 * (p - model.log_likelihood())))
+        self.assertTrue(np.isclose(BIC(model)._score, np.log(n) * p - 2 * model.log_likelihood()))
+        self.assertTrue(np.isclose(MSE(model)._score, model.get_sse() / (n - 1 - p)))
+        absorbed = LinearModel(Q("petal_width"), Q("sepal_length"), absorb=C("species"))
+        absorbed.fit(iris)
+        self.assertTrue(np.isclose(MSE(absorbed)._score, absorbed.resid_var_))
+        r_squared = 1 - model.get_sse() / model.get_sst()
+        self.assertTrue(np.isclose(RSquared(model)._score, r_squared))
+
+        class NegativeSSE(Score):
+            def __init__(self, model):
+                super(NegativeSSE, self).__init__(model, higher_is_better=True)
+
+            def compute(self):
+                return -self.summary.sse
+
+        full = LinearModel(C("species") + Q("petal_width") + Q("sepal_width"), Q("sepal_length"))
+        full.fit(iris)
+        result = stepwise(full, NegativeSSE)
+        self.assertEqual(len(result["best_model"].ex.get_terms()), 3)
+        result = stepwise(full, "cp")
+        self.assertTrue(np.isfinite(result["metric"]._score))
+
+    def test_stepwise_threads(self):
+        ex = C("species") + Q("petal_width") + Q("petal_length") + Q("sepal_width")
+        full = LinearModel(ex, Q("sepal_length"))
+        full.fit(iris)
+        for forward in (False, True):
+            serial = stepwise(full, "aic", forward=forward, naive=True)
+            threaded = stepwise(full, "aic", forward=forward, naive=True, n_jobs=3)
+            self.assertEqual(str(threaded["best_model"]), str(serial["best_model"]))
+            self.assertEqual(threaded["metric"]._score, serial["metric"]._score)
+
+    def test_best_subsets(self):
+        terms = [C("species"), Q("petal_width"), Q("petal_length"), Q("sepal_width")]
+        full = LinearModel(terms[0] + terms[1] + terms[2] + terms[3], Q("sepal_length"))
+        full.fit(iris)
+        result = best_subsets(full, "aic", max_size=3, n_best=2)
+        self.assertEqual(list(result["subsets"]), [1, 2, 3])
+        for size, found in result["subsets"].items():
+            scores = []
+            for subset in itertools.combinations(terms, size):
+                ex = subset[0]
+                for term in subset[1:]:
+                    ex = ex + term
+                model = LinearModel(ex, Q("sepal_length"))
+                model.fit(iris)
+                scores.append(AIC(model)._score)
+            expected = sorted(scores)[:2]
+            self.assertTrue(np.allclose([metric._score for metric, _ in found], expected))
+        best = min(metric._score for found in result["subsets"].values() for metric, _ in found)
+        self.assertTrue(np.isclose(result["metric"]._score, best))
+        self.assertEqual(len(result["best_model"].residuals_), len(iris))
+
+    def test_best_subsets_hierarchy(self):
+        ex = Q("petal_width") + Q("sepal_width") + Q("petal_width") * Q("sepal_width") + Q("petal_length")
+        full = LinearModel(ex, Q("sepal_length"))
+        full.fit(iris)
+        result = best_subsets(full, "r_squared", max_size=3, n_best=3)
+        self.assertEqual(len(result["subsets"][3]), 2)
+        for found in result["subsets"].values():
+            for _, model in found:
+                names = [str(term) for term in model.ex.get_terms()]
+                if "(petal_width)(sepal_width)" in names:
+                    self.assertIn("petal_width", names)
+                    self.assertIn("sepal_width", names)
+
+    def test_term_hierarchy(self):
+        ex = Q("petal_width") + Q("sepal_width") + Q("petal_width") * Q("sepal_width") + C("species")
+        full = LinearModel(ex, Q("sepal_length"))
+        full.fit(iris)
+        hierarchy = TermHierarchy.from_model(full)
+        self.assertEqual(len(hierarchy), 4)
+        interaction = "(petal_width)(sepal_width)"
+        self.assertEqual(hierarchy.parents(interaction), {"petal_width", "sepal_width"})
+        self.assertEqual(hierarchy.children(Q("petal_width")), {interaction})
+        self.assertEqual(hierarchy.children("species"), set())
+        self.assertFalse(hierarchy.can_add(interaction, {"petal_width", "species"}))
+        self.assertTrue(hierarchy.can_add(interaction, {"petal_width", "sepal_width"}))
+        self.assertFalse(hierarchy.can_remove("sepal_width", {"sepal_width", interaction}))
+        self.assertTrue(hierarchy.can_remove(interaction, {"sepal_width", interaction}))
+
+        for forward in (False, True):
+            result = stepwise(full, "r_squared", forward=forward)
+            names = set(str(term) for term in result["best_model"].ex.get_terms())
+            if interaction in names:
+                self.assertTrue(hierarchy.parents(interaction) <= names)
+
+class TestRollingMethods(unittest.TestCase):
+
+    def test_rolling_fit(self):
+        explanatory = Q("petal_width") + Q("petal_length")
+        response = Q("sepal_width")
+        model = LinearModel(explanatory, response)
+        results = rolling_fit(model, iris, window=50, step=10)
+        self.assertEqual(len(results["coef"]), 11)
+        for label in results["coef"].index[[0, 5, -1]]:
+            end = iris.index.get_loc(label) + 1
+            expected = model.fit(iris.iloc[end - 50:end])
+            expected = expected.loc[results["coef"].columns]
+            self.assertTrue(np.allclose(results["coef"].loc[label], expected["Coefficient"]))
+            self.assertTrue(np.allclose(results["se"].loc[label], expected["SE"]))
+
+    def test_expanding_fit(self):
+        model = LinearModel(Q("petal_width"), Q("sepal_width"))
+        results = rolling_fit(model, iris, window=100, step=25, expanding=True)
+        expected = model.fit(iris).loc[results["coef"].columns]
+        self.assertTrue(np.allclose(results["coef"].iloc[-1], expected["Coefficient"]))
+
+    def test_rolling_fit_dropped_level(self):
+        setosa = iris[iris.species == "setosa"]
+        versicolor = iris[iris.species == "versicolor"]
+        # versicolor leaves the windows for a while part way through
+        data = pd.concat([setosa.iloc[:1], versicolor.iloc[:3], setosa.iloc[1:7],
+                          versicolor.iloc[3:6], setosa.iloc[7:10]])
+        model = LinearModel(Q("sepal_length") + C("species"), Q("sepal_width"))
+        results = rolling_fit(model, data, window=5, step=1)
+        for label in results["coef"].index:
+            end = data.index.get_loc(label) + 1
+            window = data.iloc[end - 5:end]
+            if window.species.nunique() < 2:
+                self.assertTrue(results["coef"].loc[label].isnull().all())
+            else:
+                expected = model.fit(window).loc[results["coef"].columns]
+                self.assertTrue(np.allclose(results["coef"].loc[label], expected["Coefficient"]))
+
+class TestGroupedMethods(unittest.TestCase):
+
+    def test_fit_by(self):
+        explanatory = Q("petal_width") + Q("petal_length")
+        response = Q("sepal_width")
+        model = LinearModel(explanatory, response)
+        results = fit_by(model, iris.sample(frac=1, random_state=0), by="species")
+        self.assertEqual(len(results), 3 * 3)
+        for species, group in iris.groupby("species"):
+            expected = model.fit(group).loc[results.loc[species].index]
+            self.assertTrue(np.allclose(results.loc[species].values,
+                                        expected[["Coefficient", "SE", "t", "p"]].values))
+
+    def test_fit_by_small_group(self):
+        model = LinearModel(Q("petal_width"), Q("sepal_width"))
+        data = iris.assign(group=["a"] * 148 + ["b"] * 2)
+        results = fit_by(model, data, by="group")
+        self.assertFalse(results.loc["a"].isnull().any().any())
+        self.assertTrue(results.loc["b"].isnull().all().all())
+
 if __name__ == "__main__":
     unittest.main()
         
@@ -55,6 +55,11 @@ class Transformation():
         """
 
         return hash((self.pattern, self.name))
+
+    def _cache_key(self):
+        """Return a hashable representation of the Transformation, including
+        any learned parameters, for the purposes of caching evaluated data."""
+        return (self.name, self.pattern, id(self.func))
         
     def compose(self, inner):
         """Applies specific data to the pattern for printing. 
@@ -114,6 +119,9 @@ class Center(Transformation):
         
         return values - self.past_mean
     
+    def _cache_key(self):
+        return (self.name, float(self.past_mean))
+
     def copy(self):
         ret_val = Center()
         ret_val.past_mean = self.past_mean
@@ -140,6 +148,9 @@ class Standardize(Transformation):
             
         return (values - self.past_mean) / self.past_std    
     
+    def _cache_key(self):
+        return (self.name, float(self.past_mean), float(self.past_std))
+
     def copy(self):
         ret_val = Standardize()
         ret_val.past_mean, ret_val.past_std = self.past_mean, self.past_std